@@ -60,6 +60,19 @@ class Dataset:
         self.minibatch_idx = 0
         self.train_perm = np.random.permutation(self.num_train_samples)
 
+    def to_lazy(self, path):
+        """Store the (normalized) data as memory-mapped arrays.
+
+        Returns a LazyDataset that can be used in place of this dataset.
+        """
+        from cnn_sys_ident.utils.dataset import LazyDataset
+        return LazyDataset.create(
+            path,
+            self.images_train[...,0], self.responses_train,
+            self.images_val[...,0], self.responses_val,
+            self.images_test[...,0], self.responses_test,
+            normalize=False)
+
     @staticmethod
     def load(data_file=DATA_FILE):
         with open(data_file, 'rb') as file:
@@ -0,0 +1,170 @@
+"""Check and time the rotation matrices used by rotate_weights.
+
+rotation_interpolation() replaces tf.contrib.image.rotate by a matrix
+product. This script compares it with a per-pixel reference written after
+the ImageProjectiveTransform kernel and, if available, with
+tf.contrib.image.rotate itself, for the filter sizes and numbers of
+rotations used in the models.
+
+It then times training steps of a rotation-equivariant core as used by the
+mesonet models, with the weights rotated by rotate_weights and by the
+previous implementation based on tf.contrib.image.rotate.
+
+    python check_rotation.py
+"""
+import math
+import timeit
+import numpy as np
+import tensorflow as tf
+
+from cnn_sys_ident.architectures.utils import rotation_interpolation, rotate_weights
+
+
+FILTER_SIZES = [3, 5, 13]
+NUM_ROTATIONS = [4, 8, 16]
+TOLERANCE = 1e-5
+
+# core timed in the training graph (see StackedRotEquiConv2dCore; sizes of the
+# mesonet models)
+CORE_FILTER_SIZES = [13, 5, 5]
+CORE_NUM_FILTERS = [16, 16, 16]
+CORE_NUM_ROTATIONS = 8
+IMAGE_SIZE = [36, 64]
+BATCH_SIZE = 256
+NUM_STEPS = 50
+
+
+def rotate_reference(image, angle, interpolation):
+    """Rotate [filter_size x filter_size x channels] pixel by pixel."""
+    filter_size = image.shape[0]
+    angle = np.float32(angle)
+    cos, sin = np.cos(angle), np.sin(angle)
+    n = np.float32(filter_size - 1)
+    x_offset = (n - (cos * n - sin * n)) / np.float32(2)
+    y_offset = (n - (sin * n + cos * n)) / np.float32(2)
+
+    def read(y, x):
+        if 0 <= y < filter_size and 0 <= x < filter_size:
+            return image[int(y), int(x)]
+        return 0
+
+    output = np.zeros(image.shape)
+    for y in range(filter_size):
+        for x in range(filter_size):
+            x_in = cos * np.float32(x) - sin * np.float32(y) + x_offset
+            y_in = sin * np.float32(x) + cos * np.float32(y) + y_offset
+            if interpolation == 'NEAREST':
+                # std::round rounds halfway cases away from zero
+                output[y, x] = read(math.copysign(math.floor(abs(y_in) + 0.5), y_in),
+                                    math.copysign(math.floor(abs(x_in) + 0.5), x_in))
+            else:
+                y0, x0 = math.floor(y_in), math.floor(x_in)
+                dy, dx = y_in - y0, x_in - x0
+                output[y, x] = (1 - dy) * (1 - dx) * read(y0, x0) \
+                    + (1 - dy) * dx * read(y0, x0 + 1) \
+                    + dy * (1 - dx) * read(y0 + 1, x0) \
+                    + dy * dx * read(y0 + 1, x0 + 1)
+    return output
+
+
+def rotate_matrix(image, angle, interpolation):
+    filter_size, _, channels = image.shape
+    M = rotation_interpolation(filter_size, angle, interpolation)
+    return M.dot(image.reshape([-1, channels])).reshape(image.shape)
+
+
+def rotate_tf(session, image, angle, interpolation):
+    inputs = tf.placeholder(tf.float32, shape=image.shape)
+    rotated = tf.contrib.image.rotate(inputs, angle, interpolation=interpolation)
+    return session.run(rotated, {inputs: image})
+
+
+def rotate_weights_contrib(weights, num_rotations, first_layer=False):
+    """rotate_weights before it was based on rotation_interpolation."""
+    shape = weights.get_shape().as_list()
+    filter_size, _, num_inputs_total, num_outputs = shape
+    num_inputs = num_inputs_total // num_rotations
+    weights_flat = tf.reshape(weights, [filter_size, filter_size, num_inputs_total*num_outputs])
+    weights_rotated = []
+    for i in range(num_rotations):
+        angle = i * 2 * np.pi / num_rotations
+        w = tf.contrib.image.rotate(weights_flat, angle)
+        w = tf.reshape(w, shape)
+        if i and not first_layer:
+            shift = num_inputs_total - i * num_inputs
+            w = tf.concat([w[:,:,shift:,:], w[:,:,:shift,:]], axis=2)
+        weights_rotated.append(w)
+    return tf.concat(weights_rotated, axis=3)
+
+
+def time_training(rotate):
+    """Seconds per training step and rotated weights of a rotation-equivariant core."""
+    # same initial weights and inputs for both implementations
+    rnd = np.random.RandomState(0)
+    graph = tf.Graph()
+    with graph.as_default():
+        inputs = tf.placeholder(tf.float32, [BATCH_SIZE] + IMAGE_SIZE + [1])
+        x, weights = inputs, []
+        num_inputs = 1
+        for i, (filter_size, num_filters) in enumerate(zip(CORE_FILTER_SIZES, CORE_NUM_FILTERS)):
+            init = 0.01 * rnd.randn(filter_size, filter_size, num_inputs, num_filters)
+            w = tf.Variable(init.astype(np.float32), name='weights{:d}'.format(i))
+            w = rotate(w, CORE_NUM_ROTATIONS, first_layer=(not i))
+            weights.append(w)
+            x = tf.nn.conv2d(x, w, strides=[1, 1, 1, 1], padding='SAME')
+            x = tf.nn.elu(x)
+            num_inputs = num_filters * CORE_NUM_ROTATIONS
+        loss = tf.reduce_mean(tf.square(x))
+        train_step = tf.train.AdamOptimizer(0.001).minimize(loss)
+        feed_dict = {inputs: rnd.randn(*inputs.shape.as_list()).astype(np.float32)}
+        with tf.Session(graph=graph) as session:
+            session.run(tf.global_variables_initializer())
+            rotated = session.run(weights)
+            for _ in range(5):
+                session.run(train_step, feed_dict)  # warm up
+            t = timeit.timeit(lambda: session.run(train_step, feed_dict), number=NUM_STEPS)
+    return t / NUM_STEPS, rotated
+
+
+def max_error(a, b):
+    return np.abs(a - b).max() / max(np.abs(b).max(), 1e-12)
+
+
+def main():
+    rnd = np.random.RandomState(0)
+    session = tf.Session()
+    failed = False
+    for interpolation in ['NEAREST', 'BILINEAR']:
+        for filter_size in FILTER_SIZES:
+            image = rnd.randn(filter_size, filter_size, 32).astype(np.float32)
+            for num_rotations in NUM_ROTATIONS:
+                errors = []
+                for i in range(num_rotations):
+                    angle = i * 2 * np.pi / num_rotations
+                    matrix = rotate_matrix(image, angle, interpolation)
+                    errors.append(max_error(matrix, rotate_reference(image, angle, interpolation)))
+                    try:
+                        errors.append(max_error(matrix, rotate_tf(session, image, angle, interpolation)))
+                    except AttributeError:
+                        pass  # no tf.contrib.image
+                error = max(errors)
+                failed |= error > TOLERANCE
+                print('{:8s} size {:2d}, {:2d} rotations: max. rel. error {:.1e}'.format(
+                    interpolation, filter_size, num_rotations, error))
+
+    # time training steps with both implementations of rotate_weights
+    t, rotated = time_training(rotate_weights)
+    print('training step, rotate_weights: {:.1f} ms'.format(1000 * t))
+    try:
+        t, rotated_contrib = time_training(rotate_weights_contrib)
+        print('training step, tf.contrib.image.rotate: {:.1f} ms'.format(1000 * t))
+        error = max(max_error(a, b) for a, b in zip(rotated, rotated_contrib))
+        failed |= error > TOLERANCE
+        print('rotated weights: max. rel. error {:.1e}'.format(error))
+    except AttributeError:
+        pass  # no tf.contrib.image
+    print('FAILED' if failed else 'OK (tolerance {:.0e})'.format(TOLERANCE))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@ from tensorflow.contrib import layers
 import numpy as np
 
 from .utils import soft_threshold, rotate_weights, rotate_weights_hermite, \
-    downsample_weights
+    rotated_hermite_basis
 from ..utils.hermite import hermite_2d
 
 
@@ -39,6 +39,46 @@ def group_sparsity_regularizer_2d(W, weight=1.0):
         return penalty
 
 
+def laplacian_matrix(filter_size):
+    """Laplacian of smoothness_regularizer_2d as [pixels x pixels] matrix."""
+    lap = np.array([[0.25, 0.5, 0.25], [0.5, -3.0, 0.5], [0.25, 0.5, 0.25]])
+    L = np.zeros([filter_size] * 4)
+    for y in range(filter_size):
+        for x in range(filter_size):
+            for dy in range(-1, 2):
+                for dx in range(-1, 2):
+                    if 0 <= y + dy < filter_size and 0 <= x + dx < filter_size:
+                        L[y, x, y+dy, x+dx] = lap[dy+1, dx+1]
+    return L.reshape([filter_size ** 2, filter_size ** 2])
+
+
+def hermite_smoothness_regularizer(coeffs, basis, weight=1.0):
+    """smoothness_regularizer_2d of the rotated filters, computed on coeffs.
+
+    basis are the rotated Hermite bases [rotations, coeffs, height, width]
+    (see rotated_hermite_basis). Laplacian energy and norm of each rotated
+    filter are quadratic forms of its coefficients, so only their outer
+    products (summed over inputs) are needed. The result is the same as
+    for the rotated filters. The cost is about coeffs^2 x outputs x
+    (inputs + rotations) multiply-adds instead of 9 x height x width x
+    inputs x outputs x rotations for the Laplacian of the rotated filters,
+    so it only pays off for layers with many input channels.
+    """
+    with tf.variable_scope('smoothness'):
+        num_rotations, num_coeffs, filter_size, _ = basis.shape
+        B = basis.reshape([num_rotations, num_coeffs, -1])
+        LB = np.matmul(B, laplacian_matrix(filter_size).T)
+        Q = tf.constant(np.matmul(LB, LB.transpose([0, 2, 1])), dtype=tf.float32)
+        G = tf.constant(np.matmul(B, B.transpose([0, 2, 1])), dtype=tf.float32)
+        c = tf.transpose(coeffs, [2, 0, 1])
+        S = tf.matmul(c, c, transpose_b=True)  # [outputs, coeffs, coeffs]
+        penalty = tf.reduce_sum(tf.tensordot(Q, S, [[1, 2], [1, 2]]) / \
+                                (1e-8 + tf.tensordot(G, S, [[1, 2], [1, 2]])))
+        penalty = tf.identity(weight * penalty, name='penalty')
+        tf.add_to_collection('smoothness_regularizer_2d', penalty)
+        return penalty
+
+
 class StackedConv2dCore:
     def __init__(self,
                  base,
@@ -182,6 +222,7 @@ class StackedRotEquiHermiteConv2dCore:
                  scope='core',
                  reuse=False,
                  fused_bn=True,
+                 coeff_regularizers=False,
                  **kwargs):
         with base.tf_session.graph.as_default():
             with tf.variable_scope(scope, reuse=reuse):
@@ -195,26 +236,33 @@ class StackedRotEquiHermiteConv2dCore:
                         activation_fn, rel_smooth_weight, rel_sparse_weight)):
                     with tf.variable_scope('conv{:d}'.format(i+1)):
                         H, desc, mu = hermite_2d(fs, fs*upsampling, 2*np.sqrt(fs))
-                        H = tf.constant(H, dtype=tf.float32, name='hermite_basis')
                         n_coeffs = fs * (fs + 1) // 2
                         coeffs = tf.get_variable(
                             'coeffs',
                             shape=[n_coeffs, nf_in, nf_out],
                             initializer=tf.truncated_normal_initializer(stddev=0.1))
-                        weights = tf.tensordot(H, coeffs, axes=[[0], [0]])
-                        weights = tf.identity(downsample_weights(weights, upsampling),
-                                              name='weights')
-                        self.weights.append(weights)
+                        basis = rotated_hermite_basis(H, desc, mu, num_rotations, upsampling)
                         weights_all_rotations = rotate_weights_hermite(
-                            H, desc, mu, coeffs, num_rotations, first_layer=(not i))
+                            basis, coeffs, first_layer=(not i))
                         weights_all_rotations = tf.identity(
-                            downsample_weights(weights_all_rotations, upsampling),
-                            name='weights_all_rotations')
+                            weights_all_rotations, name='weights_all_rotations')
                         self.weights_all.append(weights_all_rotations)
 
+                        # unrotated weights are the first rotation
+                        weights = tf.identity(weights_all_rotations[...,:nf_out], name='weights')
+                        self.weights.append(weights)
+
                         # apply regularization to all rotated versions
-                        self.smooth_reg = smoothness_regularizer_2d(
-                            weights_all_rotations, conv_smooth_weight * sm)
+                        # smoothness in coefficient space where that is cheaper
+                        # (not for the first layer with its single input channel)
+                        coeff_cost = n_coeffs ** 2 * nf_out * (nf_in + num_rotations)
+                        pixel_cost = 9 * fs ** 2 * nf_in * nf_out * num_rotations
+                        if coeff_regularizers and coeff_cost < pixel_cost:
+                            self.smooth_reg = hermite_smoothness_regularizer(
+                                coeffs, basis, conv_smooth_weight * sm)
+                        else:
+                            self.smooth_reg = smoothness_regularizer_2d(
+                                weights_all_rotations, conv_smooth_weight * sm)
                         self.sparse_reg = group_sparsity_regularizer_2d(
                             weights_all_rotations, conv_sparse_weight * sp)
                         tf.losses.add_loss(
@@ -4,6 +4,18 @@ import os
 import inspect
 import random
 
+from .readouts import unit_readout
+
+
+# core output, masks, feature weights and biases of each model (see unit_readout)
+READOUT_COLLECTION = 'unit_readout'
+
+def log_path(log_dir, log_hash):
+    log_dir_ = os.path.dirname(os.path.dirname(os.path.dirname(inspect.stack()[0][1])))
+    log_dir = os.path.join(log_dir_, 'checkpoints' if log_dir is None else log_dir)
+    return os.path.join(log_dir, log_hash)
+
+
 class TFSession:
     _saver = None
     
@@ -15,10 +27,8 @@ class TFSession:
         return self._saver
     
     def __init__(self, log_dir=None, log_hash=None):
-        log_dir_ = os.path.dirname(os.path.dirname(os.path.dirname(inspect.stack()[0][1])))
-        log_dir = os.path.join(log_dir_, 'checkpoints' if log_dir is None else log_dir)
         if log_hash == None: log_hash = '%010x' % random.getrandbits(40)
-        self.log_dir = os.path.join(log_dir, log_hash)
+        self.log_dir = log_path(log_dir, log_hash)
         self.log_hash = log_hash
         self.seed = int.from_bytes(log_hash[:4].encode('utf8'), 'big')
         self.graph = tf.Graph()
@@ -46,14 +56,70 @@ class TFSession:
             self.saver.restore(self.session, os.path.join(self.log_dir, 'model.ckpt'))
 
 
+class InputPipeline:
+    """Shuffled minibatches of the training set assembled by tf.data.
+
+    Sample indices are shuffled and batched by tf.data. The samples of
+    each batch are gathered from the training arrays by num_parallel_calls
+    parallel calls and prefetched, so training steps do not need a
+    feed_dict for the data. A LazyDataset reads only the samples of each
+    batch from its memory-mapped arrays.
+    """
+    def __init__(self, data, num_parallel_calls=4, prefetch=2):
+        self.data = data
+        if hasattr(data, 'chunks'):
+            self.images, self.responses = None, None
+        else:
+            self.images, self.responses = data.train()
+        self.batch_size = tf.placeholder(tf.int64, shape=[], name='batch_size')
+        def gather(idx):
+            images, responses = tf.py_func(
+                self._gather, [idx], [tf.float32, tf.float32], stateful=False)
+            images.set_shape(data.input_shape)
+            responses.set_shape([None, data.num_neurons])
+            return images, responses
+        num_samples = data.num_train_samples
+        dataset = tf.data.Dataset.range(num_samples) \
+            .shuffle(num_samples) \
+            .repeat() \
+            .batch(self.batch_size) \
+            .map(gather, num_parallel_calls=num_parallel_calls) \
+            .prefetch(prefetch)
+        self.iterator = dataset.make_initializable_iterator()
+        self.images_batch, self.responses_batch = self.iterator.get_next()
+
+    def _gather(self, idx):
+        idx = np.sort(idx)  # sequential reads from disk
+        if self.images is None:
+            images = self.data.images('train', idx)
+            responses = self.data.responses('train', idx)
+        else:
+            images, responses = self.images[idx], self.responses[idx]
+        return images.astype(np.float32), responses.astype(np.float32)
+
+    def initialize(self, session, batch_size):
+        session.run(self.iterator.initializer, {self.batch_size: batch_size})
+
+
 class BaseModel:
-    def __init__(self, data, log_dir=None, log_hash=None):
+    def __init__(self, data, log_dir=None, log_hash=None, input_pipeline=False):
         self.tf_session = TFSession(log_dir=log_dir, log_hash=log_hash)
         self.data = data
         with self.tf_session.graph.as_default():
             self.is_training = tf.placeholder(tf.bool, name='is_training')
-            self.inputs = tf.placeholder(tf.float32, shape=data.input_shape, name='inputs')
-            self.responses = tf.placeholder(tf.float32, shape=[None, data.num_neurons], name='responses')
+            if input_pipeline:
+                # inputs and responses default to the training minibatches,
+                # but can still be fed (e.g. for validation or in-silico)
+                self.pipeline = InputPipeline(data)
+                self.inputs = tf.placeholder_with_default(
+                    self.pipeline.images_batch, shape=data.input_shape, name='inputs')
+                self.responses = tf.placeholder_with_default(
+                    self.pipeline.responses_batch, shape=[None, data.num_neurons],
+                    name='responses')
+            else:
+                self.pipeline = None
+                self.inputs = tf.placeholder(tf.float32, shape=data.input_shape, name='inputs')
+                self.responses = tf.placeholder(tf.float32, shape=[None, data.num_neurons], name='responses')
 
     def evaluate(self, var, *args, **kwargs):
         return self.tf_session.session.run(var, *args, **kwargs)
@@ -68,6 +134,27 @@ class CorePlusReadoutModel:
         self.core = core
         self.readout = readout
         self.predictions = readout.output
+        with base.tf_session.graph.as_default():
+            for tensor in [core.output, readout.masks, readout.feature_weights, readout.biases]:
+                tf.add_to_collection(READOUT_COLLECTION, tensor)
+
+    def unit_predictions(self, unit_ids, paired=False):
+        """Predictions for a subset of units (see readouts.unit_readout)."""
+        with self.base.tf_session.graph.as_default():
+            return unit_readout(self.core.output, self.readout.masks,
+                                self.readout.feature_weights, self.readout.biases,
+                                unit_ids, paired)
+
+    def load(self):
+        self.base.load()
+
+
+class ReadoutModel:
+    """Readout without core, whose inputs are precomputed core outputs."""
+    def __init__(self, base, readout):
+        self.base = base
+        self.readout = readout
+        self.predictions = readout.output
 
     def load(self):
         self.base.load()
@@ -2,7 +2,31 @@ import numpy as np
 import tensorflow as tf
 from tensorflow.contrib import layers
 
-from .utils import soft_threshold, inv_soft_threshold, sta_init
+from .utils import soft_threshold, inv_soft_threshold, train_sta_init, train_responses
+
+
+def unit_readout(inputs, masks, feature_weights, biases, unit_ids, paired=False):
+    """Readout of a subset of units.
+
+    Only the masks, feature weights and biases of the requested units are
+    used. unit_ids is either a single unit (returns [batch]), a list of
+    units (returns [batch, units]) or, if paired, one unit per input
+    (returns [batch]).
+    """
+    unit_ids = tf.convert_to_tensor(unit_ids, dtype=tf.int32)
+    masks = tf.gather(masks, unit_ids)
+    feature_weights = tf.gather(feature_weights, unit_ids)
+    biases = tf.gather(biases, unit_ids)
+    if unit_ids.shape.ndims == 0:
+        masked = tf.tensordot(inputs, masks, [[1, 2], [0, 1]])
+        h = tf.tensordot(masked, feature_weights, [[1], [0]])
+    elif paired:
+        masked = tf.reduce_sum(inputs * masks[:,:,:,None], [1, 2])
+        h = tf.reduce_sum(masked * feature_weights, 1)
+    else:
+        masked = tf.tensordot(inputs, masks, [[1, 2], [1, 2]])
+        h = tf.reduce_sum(masked * tf.transpose(feature_weights), 1)
+    return soft_threshold(h + biases)
 
 
 class SpatialXFeatureJointL1Readout:
@@ -23,10 +47,8 @@ class SpatialXFeatureJointL1Readout:
 
                 # masks
                 if init_masks == 'sta':
-                    images_train, responses_train = data.train()
-                    k = (images_train.shape[1] - num_px_y) // 2
-                    mask_init = sta_init(images_train, responses_train,
-                                         max_val=0.01, sd=0.001)[:,k:-k,k:-k]
+                    k = (data.input_shape[1] - num_px_y) // 2
+                    mask_init = train_sta_init(data, max_val=0.01, sd=0.001)[:,k:-k,k:-k]
                     mask_init = tf.constant_initializer(mask_init)
                 else:
                     mask_init = tf.truncated_normal_initializer(mean=0.0, stddev=0.01)
@@ -53,7 +75,7 @@ class SpatialXFeatureJointL1Readout:
                 tf.losses.add_loss(self.readout_reg, tf.GraphKeys.REGULARIZATION_LOSSES)
 
                 # bias and output nonlinearity
-                _, responses = data.train()
+                responses = train_responses(data)
                 bias_init = 0.5 * inv_soft_threshold(responses.mean(axis=0))
                 self.biases = tf.get_variable(
                     'biases',
@@ -81,10 +103,8 @@ class SpatialXFeatureSeparateL1Readout:
 
                 # masks
                 if init_masks == 'sta':
-                    images_train, responses_train = data.train()
-                    k = (images_train.shape[1] - num_px_y) // 2
-                    mask_init = sta_init(images_train, responses_train,
-                                         max_val=0.01, sd=0.001)[:,k:-k,k:-k]
+                    k = (data.input_shape[1] - num_px_y) // 2
+                    mask_init = train_sta_init(data, max_val=0.01, sd=0.001)[:,k:-k,k:-k]
                     mask_init = tf.constant_initializer(mask_init)
                 else:
                     mask_init = tf.truncated_normal_initializer(mean=0.0, stddev=0.01)
@@ -111,7 +131,7 @@ class SpatialXFeatureSeparateL1Readout:
                 tf.losses.add_loss(self.readout_reg, tf.GraphKeys.REGULARIZATION_LOSSES)
 
                 # bias and output nonlinearity
-                _, responses = data.train()
+                responses = train_responses(data)
                 bias_init = 0.5 * inv_soft_threshold(responses.mean(axis=0))
                 self.biases = tf.get_variable(
                     'biases',
@@ -138,9 +158,8 @@ class SpatialSparseXFeatureDenseReadout:
 
                 # masks
                 if init_masks == 'sta':
-                    images_train, responses_train = data.train()
-                    k = (images_train.shape[1] - num_px_y) // 2
-                    mask_init = sta_init(images_train, responses_train)[:,k:-k,k:-k]
+                    k = (data.input_shape[1] - num_px_y) // 2
+                    mask_init = train_sta_init(data)[:,k:-k,k:-k]
                     mask_init = tf.constant_initializer(mask_init)
                 else:
                     mask_init = tf.truncated_normal_initializer(mean=0.0, stddev=0.01)
@@ -167,7 +186,7 @@ class SpatialSparseXFeatureDenseReadout:
                 tf.losses.add_loss(self.readout_reg, tf.GraphKeys.REGULARIZATION_LOSSES)
 
                 # bias and output nonlinearity
-                _, responses = data.train()
+                responses = train_responses(data)
                 bias_init = 0.5 * inv_soft_threshold(responses.mean(axis=0))
                 self.biases = tf.get_variable(
                     'biases',
@@ -195,9 +214,8 @@ class SpatialSparseXFeatureDenseSeparateReadout:
 
                 # masks
                 if init_masks == 'sta':
-                    images_train, responses_train = data.train()
-                    k = (images_train.shape[1] - num_px_y) // 2
-                    mask_init = sta_init(images_train, responses_train)[:,k:-k,k:-k]
+                    k = (data.input_shape[1] - num_px_y) // 2
+                    mask_init = train_sta_init(data)[:,k:-k,k:-k]
                     mask_init = tf.constant_initializer(mask_init)
                 else:
                     mask_init = tf.truncated_normal_initializer(mean=0.0, stddev=0.01)
@@ -224,7 +242,7 @@ class SpatialSparseXFeatureDenseSeparateReadout:
                 tf.losses.add_loss(self.readout_reg, tf.GraphKeys.REGULARIZATION_LOSSES)
 
                 # bias and output nonlinearity
-                _, responses = data.train()
+                responses = train_responses(data)
                 bias_init = 0.5 * inv_soft_threshold(responses.mean(axis=0))
                 self.biases = tf.get_variable(
                     'biases',
@@ -252,10 +270,8 @@ class SpatialXFeatureJointL1TransferReadout:
 
                 # masks
                 if init_masks == 'sta':
-                    images_train, responses_train = data.train()
-                    k = (images_train.shape[1] - num_px_y) // 2
-                    mask_init = sta_init(images_train, responses_train,
-                                         max_val=0.01, sd=0.001)[:,k:-k,k:-k]
+                    k = (data.input_shape[1] - num_px_y) // 2
+                    mask_init = train_sta_init(data, max_val=0.01, sd=0.001)[:,k:-k,k:-k]
                     mask_init = tf.constant_initializer(mask_init)
                 else:
                     mask_init = tf.truncated_normal_initializer(mean=0.0, stddev=0.01)
@@ -301,7 +317,7 @@ class SpatialXFeatureJointL1TransferReadout:
                 tf.losses.add_loss(self.readout_reg, tf.GraphKeys.REGULARIZATION_LOSSES)
 
                 # bias and output nonlinearity
-                _, responses = data.train()
+                responses = train_responses(data)
                 bias_init = 0.5 * inv_soft_threshold(responses.mean(axis=0))
                 self.biases = tf.get_variable(
                     'biases',
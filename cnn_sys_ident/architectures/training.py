@@ -1,25 +1,121 @@
+import os
 import tensorflow as tf
 import numpy as np
-from scipy import stats
 
-from .utils import poisson
+from .utils import poisson, poisson_per_sample
+
+
+class StreamingStats:
+    """Per-neuron sufficient statistics of responses and predictions.
+
+    Accumulated chunk by chunk, so large datasets never have to be held
+    in a single array.
+    """
+    def __init__(self, num_neurons):
+        self.n = 0
+        self.sum_res = np.zeros(num_neurons)
+        self.sum_pred = np.zeros(num_neurons)
+        self.sum_res_sq = np.zeros(num_neurons)
+        self.sum_pred_sq = np.zeros(num_neurons)
+        self.sum_prod = np.zeros(num_neurons)
+
+    def update(self, responses, predictions):
+        res = np.asarray(responses, dtype=np.float64)
+        pred = np.asarray(predictions, dtype=np.float64)
+        self.n += res.shape[0]
+        self.sum_res += res.sum(axis=0)
+        self.sum_pred += pred.sum(axis=0)
+        self.sum_res_sq += np.square(res).sum(axis=0)
+        self.sum_pred_sq += np.square(pred).sum(axis=0)
+        self.sum_prod += (res * pred).sum(axis=0)
+
+    def correlation(self, min_std=1e-5):
+        """Pearson correlation for all neurons.
+
+        Neurons whose responses or predictions have SD below min_std get
+        a correlation of zero.
+        """
+        mean_res = self.sum_res / self.n
+        mean_pred = self.sum_pred / self.n
+        std_res = np.sqrt(np.maximum(self.sum_res_sq / self.n - mean_res ** 2, 0))
+        std_pred = np.sqrt(np.maximum(self.sum_pred_sq / self.n - mean_pred ** 2, 0))
+        cov = self.sum_prod / self.n - mean_res * mean_pred
+        valid = (std_res > min_std) & (std_pred > min_std)
+        rho = np.zeros(self.sum_res.shape)
+        rho[valid] = cov[valid] / (std_res[valid] * std_pred[valid])
+        return np.clip(rho, -1, 1)
+
+
+def correlation(responses, predictions, min_std=1e-5):
+    """Per-neuron correlation between responses and predictions [samples x neurons]."""
+    statistics = StreamingStats(responses.shape[1])
+    statistics.update(responses, predictions)
+    return statistics.correlation(min_std)
+
+
+class WeightSnapshot:
+    """In-memory copy of a set of variables.
+
+    Saving and restoring are single grouped assign ops, i.e. copies on the
+    device instead of checkpoint files. The shadow variables are local
+    variables, so they are not written to checkpoints.
+    """
+    def __init__(self, variables, scope='snapshot'):
+        with tf.variable_scope(scope):
+            self.shadows = [
+                tf.Variable(tf.zeros(v.shape, dtype=v.dtype.base_dtype),
+                            trainable=False,
+                            collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                            name=v.op.name)
+                for v in variables]
+            self.initializer = tf.variables_initializer(self.shadows)
+            self.save = tf.group(*[s.assign(v) for s, v in zip(self.shadows, variables)],
+                                 name='save')
+            self.restore = tf.group(*[v.assign(s) for s, v in zip(self.shadows, variables)],
+                                    name='restore')
+
+
+def chunks(data, split, chunk_size):
+    """Iterate over (inputs, responses) of a split ('train', 'val', 'test').
+
+    Datasets with a chunks() method (LazyDataset) read only one chunk at a
+    time from disk. Test responses are averaged over repeats.
+    """
+    if hasattr(data, 'chunks'):
+        for chunk in data.chunks(split, chunk_size):
+            yield chunk
+    else:
+        inputs, responses = getattr(data, split)()
+        for start in range(0, inputs.shape[0], chunk_size):
+            yield inputs[start:start+chunk_size], responses[start:start+chunk_size]
+
+
+def model_variables(scope=None):
+    """Trainable variables plus batch norm statistics, but no optimizer state."""
+    variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope)
+    return variables + [v for v in tf.get_collection(tf.GraphKeys.MODEL_VARIABLES, scope)
+                        if v not in variables]
 
 
 class Trainer:
     
-    def __init__(self, base, model):
+    def __init__(self, base, model, chunk_size=1000):
         self.base = base
         self.session = base.tf_session.session
         self.graph = base.tf_session.graph
         self.data = base.data
         self.model = model
+        self.chunk_size = chunk_size
         with self.graph.as_default():
             self.learning_rate = tf.placeholder(tf.float32, name='learning_rate')
             self.poisson = poisson(model.predictions, base.responses)
+            self.poisson_sum = tf.reduce_sum(
+                poisson_per_sample(model.predictions, base.responses), name='poisson_sum')
             self.reg_loss = tf.losses.get_regularization_loss()
             self.total_loss = self.poisson + self.reg_loss
             self.train_step = tf.train.AdamOptimizer(
                 self.learning_rate).minimize(self.total_loss)
+            self.snapshot = None
 
     def fit(self,
             max_iter=10000,
@@ -27,41 +123,52 @@ class Trainer:
             batch_size=256,
             val_steps=100,
             patience=5,
-            lr_decay_steps=2):
+            lr_decay_steps=2,
+            checkpoint_in_memory=False):
         with self.graph.as_default():
             update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-            inputs_val, res_val = self.data.val()
             val_loss = np.inf
             not_improved = 0
             iter_num = 0
+            if checkpoint_in_memory and self.snapshot is None:
+                self.snapshot = WeightSnapshot(model_variables())
             self.session.run(tf.global_variables_initializer())
+            if checkpoint_in_memory:
+                self.session.run(self.snapshot.initializer)
+            pipeline = self.base.pipeline
+            if pipeline is not None:
+                pipeline.initialize(self.session, batch_size)
             for _ in range(lr_decay_steps):
                 while iter_num < max_iter:
 
                     # training step
-                    imgs_batch, res_batch = self.data.minibatch(batch_size)
-                    feed_dict = {self.base.inputs: imgs_batch,
-                                 self.base.responses: res_batch,
-                                 self.base.is_training: True,
+                    feed_dict = {self.base.is_training: True,
                                  self.learning_rate: learning_rate}
+                    if pipeline is None:
+                        imgs_batch, res_batch = self.data.minibatch(batch_size)
+                        feed_dict[self.base.inputs] = imgs_batch
+                        feed_dict[self.base.responses] = res_batch
                     self.session.run([self.train_step, update_ops], feed_dict)
                     iter_num += 1
 
                     # validate/save periodically
                     if not (iter_num % val_steps):
-                        feed_dict_val = {self.base.inputs: inputs_val,
-                                         self.base.responses: res_val,
-                                         self.base.is_training: False}
-                        loss = self.session.run(self.poisson, feed_dict_val)
+                        loss, _ = self.evaluate('val')
                         print('{:4d} | Loss: {:.2f}'.format(iter_num, loss))
                         if loss < val_loss:
                             val_loss = loss
-                            self.base.tf_session.save()
+                            if checkpoint_in_memory:
+                                self.session.run(self.snapshot.save)
+                            else:
+                                self.base.tf_session.save()
                             not_improved = 0
                         else:
                             not_improved += 1
                         if not_improved == patience:
-                            self.base.tf_session.load()
+                            if checkpoint_in_memory:
+                                self.session.run(self.snapshot.restore)
+                            else:
+                                self.base.tf_session.load()
                             iter_num -= patience * val_steps
                             not_improved = 0
                             break
@@ -69,32 +176,185 @@ class Trainer:
                 learning_rate /= 10
                 print('Reducing learning rate to {:f}'.format(learning_rate))
 
+            # test on the best weights, i.e. those of the checkpoint, in
+            # both modes (in memory, they are written to disk only once)
+            if val_loss < np.inf:
+                if checkpoint_in_memory:
+                    self.session.run(self.snapshot.restore)
+                    self.base.tf_session.save()
+                else:
+                    self.base.tf_session.load()
+
             test_corr = self.compute_test_corr()
         return iter_num, val_loss, test_corr
 
-    def compute_test_corr(self, average=True):
-        with self.graph.as_default():
-            inputs, responses = self.data.test()
+    def evaluate(self, split='val'):
+        """Poisson loss and response statistics of a split, evaluated in chunks.
+
+        Peak memory is bounded by chunk_size instead of the size of the
+        dataset (see chunks()). The loss equals evaluating self.poisson on
+        all data at once within float tolerance (the summation order
+        differs).
+        """
+        num_samples = 0
+        statistics = StreamingStats(self.data.num_neurons)
+        loss = 0.0
+        for inputs, responses in chunks(self.data, split, self.chunk_size):
             feed_dict = {self.base.inputs: inputs,
                          self.base.responses: responses,
                          self.base.is_training: False}
-            predictions = self.session.run(self.model.predictions, feed_dict)
-        rho = np.zeros(self.data.num_neurons)
-        for i, (res, pred) in enumerate(zip(responses.T, predictions.T)):
-            if np.std(res) > 1e-5 and np.std(pred) > 1e-5:
-                rho[i] = stats.pearsonr(res, pred)[0]
+            loss_sum, predictions = self.session.run(
+                [self.poisson_sum, self.model.predictions], feed_dict)
+            loss += loss_sum
+            num_samples += inputs.shape[0]
+            statistics.update(responses, predictions)
+        return loss / num_samples, statistics
+
+    def compute_test_corr(self, average=True):
+        _, statistics = self.evaluate('test')
+        rho = statistics.correlation()
         return rho.mean() if average else rho
 
     def compute_val_corr(self):
+        _, statistics = self.evaluate('val')
+        return statistics.correlation()
+
+
+class PackedTrainer:
+    """Trains several replicas of a model side by side in one graph.
+
+    The replicas (e.g. different regularization settings of the same model)
+    share the inputs, so every minibatch is fed to all of them at once.
+    Each replica has its own optimizer, learning rate schedule and early
+    stopping, using in-memory snapshots of its best weights.
+
+    Replica i has to be built in variable scope scopes[i]. Its best weights
+    (and optimizer state) are written to log_dirs[i] with that prefix
+    stripped, so the checkpoint can be restored into a regular single model.
+
+    Since all replicas share one graph, their random initializations differ
+    from those of separately built models. init_values[i] (variable names
+    without scope prefix -> values, see model_variables) overrides the
+    initial values of replica i.
+    """
+    def __init__(self, base, models, scopes, log_dirs, chunk_size=1000, init_values=None):
+        self.base = base
+        self.session = base.tf_session.session
+        self.graph = base.tf_session.graph
+        self.data = base.data
+        self.models = models
+        self.scopes = [scope + '/' for scope in scopes]
+        self.log_dirs = log_dirs
+        self.chunk_size = chunk_size
+        self.init_values = init_values
         with self.graph.as_default():
-            inputs, responses = self.data.val()
+            self.learning_rates = []
+            self.poisson_sums = []
+            self.train_steps = []
+            for model, scope in zip(models, self.scopes):
+                with tf.name_scope(scope):
+                    learning_rate = tf.placeholder(tf.float32, name='learning_rate')
+                    poisson_loss = poisson(model.predictions, base.responses)
+                    reg_loss = tf.losses.get_regularization_loss(scope)
+                    update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS, scope)
+                    train_step = tf.train.AdamOptimizer(learning_rate).minimize(
+                        poisson_loss + reg_loss, var_list=tf.trainable_variables(scope))
+                    self.learning_rates.append(learning_rate)
+                    self.poisson_sums.append(tf.reduce_sum(
+                        poisson_per_sample(model.predictions, base.responses),
+                        name='poisson_sum'))
+                    self.train_steps.append([train_step, update_ops])
+            self.snapshots = [WeightSnapshot(model_variables(scope), scope + 'snapshot')
+                              for scope in self.scopes]
+            # after the optimizers, so checkpoints include their slots
+            self.savers = [
+                tf.train.Saver({v.op.name[len(scope):]: v for v in tf.global_variables(scope)},
+                               max_to_keep=1)
+                for scope in self.scopes]
+
+    def fit(self,
+            max_iter=10000,
+            learning_rate=0.001,
+            batch_size=256,
+            val_steps=100,
+            patience=5,
+            lr_decay_steps=2):
+        num_replicas = len(self.models)
+        with self.graph.as_default():
+            learning_rates = np.full(num_replicas, learning_rate)
+            val_loss = np.full(num_replicas, np.inf)
+            not_improved = np.zeros(num_replicas, dtype=int)
+            iter_num = np.zeros(num_replicas, dtype=int)
+            decay_step = np.zeros(num_replicas, dtype=int)
+            self.session.run(tf.global_variables_initializer())
+            if self.init_values is not None:
+                for scope, values in zip(self.scopes, self.init_values):
+                    for v in model_variables(scope):
+                        v.load(values[v.op.name[len(scope):]], self.session)
+            self.session.run([s.initializer for s in self.snapshots])
+            pipeline = self.base.pipeline
+            if pipeline is not None:
+                pipeline.initialize(self.session, batch_size)
+            while True:
+                active = np.where((decay_step < lr_decay_steps) & (iter_num < max_iter))[0]
+                if not len(active):
+                    break
+
+                # training step for all replicas that are not done yet
+                feed_dict = {self.base.is_training: True}
+                for i in active:
+                    feed_dict[self.learning_rates[i]] = learning_rates[i]
+                if pipeline is None:
+                    imgs_batch, res_batch = self.data.minibatch(batch_size)
+                    feed_dict[self.base.inputs] = imgs_batch
+                    feed_dict[self.base.responses] = res_batch
+                self.session.run([self.train_steps[i] for i in active], feed_dict)
+                iter_num[active] += 1
+
+                # validate/save periodically (active replicas are in sync)
+                if not (iter_num[active[0]] % val_steps):
+                    loss, _ = self.evaluate('val', active)
+                    print(' | '.join('{:d}: {:4d} {:.2f}'.format(i, iter_num[i], l)
+                                     for i, l in zip(active, loss)))
+                    better = loss < val_loss[active]
+                    improved = active[better]
+                    val_loss[improved] = loss[better]
+                    not_improved[active] += 1
+                    not_improved[improved] = 0
+                    self.session.run([self.snapshots[i].save for i in improved])
+                    stop = active[not_improved[active] == patience]
+                    self.session.run([self.snapshots[i].restore for i in stop])
+                    iter_num[stop] -= patience * val_steps
+                    not_improved[stop] = 0
+                    decay_step[stop] += 1
+                    learning_rates[stop] /= 10
+
+            # keep best weights and write them to disk once
+            done = np.where(val_loss < np.inf)[0]
+            self.session.run([self.snapshots[i].restore for i in done])
+            for i in done:
+                self.savers[i].save(self.session, os.path.join(self.log_dirs[i], 'model.ckpt'))
+
+            _, statistics = self.evaluate('test')
+            test_corr = [s.correlation().mean() for s in statistics]
+        return list(zip(iter_num, val_loss, test_corr))
+
+    def evaluate(self, split='val', replicas=None):
+        """Poisson loss and response statistics of replicas, evaluated in chunks."""
+        if replicas is None:
+            replicas = np.arange(len(self.models))
+        num_samples = 0
+        statistics = [StreamingStats(self.data.num_neurons) for _ in replicas]
+        loss = np.zeros(len(replicas))
+        for inputs, responses in chunks(self.data, split, self.chunk_size):
             feed_dict = {self.base.inputs: inputs,
                          self.base.responses: responses,
                          self.base.is_training: False}
-            predictions = self.session.run(self.model.predictions, feed_dict)
-        rho = np.zeros(self.data.num_neurons)
-        for i, (res, pred) in enumerate(zip(responses.T, predictions.T)):
-            if np.std(res) > 1e-5 and np.std(pred) > 1e-5:
-                rho[i] = stats.pearsonr(res, pred)[0]
-        return rho
-
+            loss_sums, predictions = self.session.run(
+                [[self.poisson_sums[i] for i in replicas],
+                 [self.models[i].predictions for i in replicas]], feed_dict)
+            loss += loss_sums
+            num_samples += inputs.shape[0]
+            for s, p in zip(statistics, predictions):
+                s.update(responses, p)
+        return loss / num_samples, statistics
@@ -13,50 +13,122 @@ def inv_soft_threshold(x):
 
 
 def poisson(prediction, response):
-    return tf.reduce_mean(tf.reduce_sum(
-        prediction - response * tf.log(prediction + 1e-5), 1), name='poisson')
-
-
-def rotate_weights(weights, num_rotations, first_layer=False):
+    return tf.reduce_mean(poisson_per_sample(prediction, response), name='poisson')
+
+
+def poisson_per_sample(prediction, response):
+    return tf.reduce_sum(prediction - response * tf.log(prediction + 1e-5), 1)
+
+
+def rotation_interpolation(filter_size, angle, interpolation='NEAREST'):
+    """Matrix rotating a [filter_size x filter_size] filter (flattened).
+
+    Emulates tf.contrib.image.rotate: the output pixel (x, y) is read from
+    the input at the inverse rotation around the center, with nearest
+    neighbor or bilinear interpolation and zeros outside the filter.
+    """
+    # same (float32) transform as angles_to_projective_transforms
+    angle = np.float32(angle)
+    cos, sin = np.cos(angle), np.sin(angle)
+    n = np.float32(filter_size - 1)
+    x_offset = (n - (cos * n - sin * n)) / np.float32(2)
+    y_offset = (n - (sin * n + cos * n)) / np.float32(2)
+    y, x = np.mgrid[:filter_size, :filter_size].astype(np.float32)
+    x_in = (cos * x - sin * y + x_offset).ravel()
+    y_in = (sin * x + cos * y + y_offset).ravel()
+    if interpolation == 'NEAREST':
+        # std::round, i.e. halfway cases away from zero
+        points = [(np.sign(y_in) * np.floor(np.abs(y_in) + 0.5),
+                   np.sign(x_in) * np.floor(np.abs(x_in) + 0.5),
+                   np.ones(x_in.shape))]
+    elif interpolation == 'BILINEAR':
+        y0, x0 = np.floor(y_in), np.floor(x_in)
+        dy, dx = y_in - y0, x_in - x0
+        points = [(y0, x0, (1 - dy) * (1 - dx)),
+                  (y0, x0 + 1, (1 - dy) * dx),
+                  (y0 + 1, x0, dy * (1 - dx)),
+                  (y0 + 1, x0 + 1, dy * dx)]
+    else:
+        raise ValueError('Unknown interpolation: {}'.format(interpolation))
+    M = np.zeros([filter_size ** 2, filter_size ** 2])
+    out = np.arange(filter_size ** 2)
+    for yi, xi, w in points:
+        valid = (yi >= 0) & (yi < filter_size) & (xi >= 0) & (xi < filter_size)
+        idx = (yi * filter_size + xi)[valid].astype(int)
+        np.add.at(M, (out[valid], idx), w[valid])
+    return M
+
+
+def rotate_weights(weights, num_rotations, first_layer=False, interpolation='NEAREST'):
     # shape = [filter_size, filter_size, num_rotations*num_inputs, num_outputs]
     shape = weights.get_shape().as_list()
     filter_size, _, num_inputs_total, num_outputs = shape
-    num_inputs = num_inputs_total // num_rotations
-    weights_flat = tf.reshape(weights, [filter_size, filter_size, num_inputs_total*num_outputs])
-    weights_rotated = []
-    for i in range(num_rotations):
-        angle = i * 2 * np.pi / num_rotations
-        w = tf.contrib.image.rotate(weights_flat, angle)
-        w = tf.reshape(w, shape)
-        if i and not first_layer:
-            shift = num_inputs_total - i * num_inputs
-            begin_a = [0, 0, shift, 0]
-            size_a = [filter_size, filter_size, num_inputs_total-shift, num_outputs]
-            begin_b = [0, 0, 0, 0]
-            size_b = [filter_size, filter_size, shift, num_outputs]
-            w = tf.concat([tf.slice(w, begin_a, size_a), tf.slice(w, begin_b, size_b)], axis=2)
-        weights_rotated.append(w)
-    weights_all_rotations = tf.concat(weights_rotated, axis=3, name='weights_all_rotations')
+
+    # all rotations as one [rotations*pixels x pixels] matrix
+    angles = np.arange(num_rotations) * 2 * np.pi / num_rotations
+    M = np.concatenate([rotation_interpolation(filter_size, a, interpolation) for a in angles])
+    M = tf.constant(M, dtype=tf.float32, name='rotation_matrices')
+    weights_flat = tf.reshape(weights, [filter_size ** 2, num_inputs_total * num_outputs])
+    w = tf.reshape(tf.matmul(M, weights_flat),
+                   [num_rotations, filter_size, filter_size, num_inputs_total, num_outputs])
+    w = tf.transpose(w, [0, 3, 1, 2, 4])
+    if not first_layer:
+        # channel cycling of all rotations as one gather
+        idx = channel_cycling(num_inputs_total, num_rotations)
+        idx += num_inputs_total * np.arange(num_rotations)[:,None]
+        w = tf.gather(tf.reshape(w, [num_rotations * num_inputs_total, filter_size, filter_size, num_outputs]),
+                      idx.ravel())
+        w = tf.reshape(w, [num_rotations, num_inputs_total, filter_size, filter_size, num_outputs])
+    w = tf.transpose(w, [2, 3, 1, 0, 4])
+    weights_all_rotations = tf.reshape(
+        w, [filter_size, filter_size, num_inputs_total, num_rotations * num_outputs],
+        name='weights_all_rotations')
     return weights_all_rotations
 
 
-def rotate_weights_hermite(H, desc, mu, coeffs, num_rotations, first_layer=False):
-    num_coeffs, num_inputs_total, num_outputs = coeffs.shape.as_list()
-    filter_size = int(H.shape[1])
+def rotated_hermite_basis(H, desc, mu, num_rotations, upsampling=1):
+    """Hermite basis for all rotations [rotations, coeffs, height, width].
+
+    Rotating the filter sum_k c_k H_k by angle a gives the coefficients
+    R_a c, so the rotated filter is sum_k c_k (R_a^T H)_k. The basis is
+    downsampled by upsampling (see downsample_weights).
+    """
+    angles = np.arange(num_rotations) * 2 * np.pi / num_rotations
+    basis = np.stack([np.tensordot(rotation_matrix(desc, mu, a), H, axes=[[0], [0]])
+                      for a in angles])
+    return downsample_weights(basis.transpose([2, 3, 0, 1]), upsampling).transpose([2, 3, 0, 1])
+
+
+def channel_cycling(num_inputs_total, num_rotations):
+    """Input channels of the rotated filters [rotations, inputs].
+
+    Rotating a filter of a rotation-equivariant layer cyclically shifts its
+    inputs by the number of features per rotation.
+    """
     num_inputs = num_inputs_total // num_rotations
-    weights_rotated = []
-    for i in range(num_rotations):
-        angle = i * 2 * np.pi / num_rotations
-        R = rotation_matrix(desc, mu, angle)
-        R = tf.constant(R, dtype=tf.float32, name='R')
-        coeffs_rotated = tf.tensordot(R, coeffs, axes=[[1], [0]])
-        w = tf.tensordot(H, coeffs_rotated, axes=[[0], [0]],
-                         name='weights_rotated_{}'.format(i))
-        if i and not first_layer:
-            shift = num_inputs_total - i * num_inputs
-            w = tf.concat([w[:,:,shift:,:], w[:,:,:shift,:]], axis=2)
-        weights_rotated.append(w)
-    weights_all_rotations = tf.concat(weights_rotated, axis=3)
+    idx = np.arange(num_inputs_total)
+    return np.stack([np.roll(idx, i * num_inputs) for i in range(num_rotations)])
+
+
+def rotate_weights_hermite(basis, coeffs, first_layer=False):
+    # basis: precomputed rotated (and downsampled) basis, see rotated_hermite_basis
+    num_coeffs, num_inputs_total, num_outputs = coeffs.shape.as_list()
+    num_rotations, _, filter_size, _ = basis.shape
+    basis = basis.reshape([num_rotations, num_coeffs, -1]).transpose([0, 2, 1])
+    if first_layer:
+        basis = tf.constant(basis.reshape([-1, num_coeffs]), dtype=tf.float32,
+                            name='rotated_hermite_basis')
+        coeffs = tf.reshape(coeffs, [num_coeffs, -1])
+    else:
+        basis = tf.constant(basis, dtype=tf.float32, name='rotated_hermite_basis')
+        idx = channel_cycling(num_inputs_total, num_rotations)
+        coeffs = tf.gather(tf.transpose(coeffs, [1, 0, 2]), idx)
+        coeffs = tf.reshape(tf.transpose(coeffs, [0, 2, 1, 3]), [num_rotations, num_coeffs, -1])
+    w = tf.matmul(basis, coeffs)
+    w = tf.reshape(w, [num_rotations, filter_size, filter_size, num_inputs_total, num_outputs])
+    w = tf.transpose(w, [1, 2, 3, 0, 4])
+    weights_all_rotations = tf.reshape(
+        w, [filter_size, filter_size, num_inputs_total, num_rotations * num_outputs])
     return weights_all_rotations
 
 
@@ -81,8 +153,40 @@ def sta_init(x, y, k=51, alpha=10, max_val=0.1, sd=0.01):
     x = (x - x.mean()) / x.std()
     y = (y - y.mean(axis=0)) / y.std(axis=0)
     w = np.tensordot(y, x, axes=[[0], [0]])
+    return sta_envelope(w, k, alpha, max_val, sd)
+
+
+def sta_envelope(w, k=51, alpha=10, max_val=0.1, sd=0.01):
     e = envelope(w, k)
     e = (e / np.max(e, axis=(1, 2), keepdims=True)) ** alpha
     e *= max_val
     e += np.random.normal(size=e.shape) * sd
     return e
+
+
+def train_responses(data):
+    """Training responses. A LazyDataset does not read its images for this."""
+    if hasattr(data, 'chunks'):
+        return data.responses('train')
+    return data.train()[1]
+
+
+def train_sta_init(data, k=51, alpha=10, max_val=0.1, sd=0.01):
+    """sta_init on the training set. A LazyDataset is read in chunks."""
+    if not hasattr(data, 'chunks'):
+        images, responses = data.train()
+        return sta_init(images, responses, k, alpha, max_val, sd)
+    y = train_responses(data)
+    y = (y - y.mean(axis=0)) / y.std(axis=0)
+    w, start, n, sum_x, sum_x_sq = 0, 0, 0, 0.0, 0.0
+    for x, _ in data.chunks('train'):
+        x = x[:,:,:,0]
+        w = w + np.tensordot(y[start:start+x.shape[0]], x, axes=[[0], [0]])
+        start += x.shape[0]
+        n += x.size
+        sum_x += x.sum()
+        sum_x_sq += np.square(x).sum()
+    # same as normalizing the images first
+    mean = sum_x / n
+    w = (w - mean * y.sum(axis=0)[:,None,None]) / np.sqrt(sum_x_sq / n - mean ** 2)
+    return sta_envelope(w, k, alpha, max_val, sd)
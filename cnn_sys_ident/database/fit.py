@@ -1,14 +1,21 @@
 import datajoint as dj
+import tensorflow as tf
+import random
 import os
+import shutil
 
-from ..architectures.training import Trainer
-from ..architectures.models import BaseModel
-from ..utils.data import key_hash
+from ..architectures.training import Trainer, PackedTrainer, model_variables
+from ..architectures.models import BaseModel, log_path
+from ..utils.data import key_hash, populate_reserved
+from ..utils.features import FeatureStore, FeatureDataset
 
 
 class Fit:
     _reg_path_table = None
     _data_table = None
+    _input_pipeline = False
+    _checkpoint_in_memory = False
+    _fit_kwargs = dict()
     
     @property
     def definition(self):
@@ -29,15 +36,141 @@ class Fit:
         key = (self.key_source & key).fetch1(dj.key)
         return key_hash(key)
 
-    def get_model(self, key):
+    def get_model(self, key, input_pipeline=False):
+        """Build the model of key.
+
+        Use input_pipeline=self._input_pipeline for models that are trained;
+        graphs used only for inference are built without the pipeline.
+        """
         log_hash = self.get_hash(key)
         data = (self._data_table() & key).load_data()
         log_dir = os.path.join('checkpoints', self._data_table.database)
-        base = BaseModel(data, log_dir=log_dir, log_hash=log_hash)
+        base = BaseModel(data, log_dir=log_dir, log_hash=log_hash,
+                         input_pipeline=input_pipeline)
         model = self._reg_path_table().build_model(key, base)
         return model
 
+    def checkpoint_file(self, key):
+        log_dir = os.path.join('checkpoints', self._data_table.database)
+        return os.path.join(log_path(log_dir, self.get_hash(key)), 'model.ckpt')
+
+    def feature_store(self, key, name, images, num_images=None, **kwargs):
+        """Core outputs of the fitted model for a stimulus set, cached on disk.
+
+        name identifies the stimulus set. The features are stored next to
+        the checkpoint and recomputed if the model was refitted since. See
+        FeatureStore.create for the other arguments.
+        """
+        checkpoint_file = self.checkpoint_file(key)
+        path = os.path.join(os.path.dirname(checkpoint_file), 'features', name)
+        if os.path.isdir(path):
+            if os.path.getmtime(path) >= os.path.getmtime(checkpoint_file + '.index'):
+                return FeatureStore(path)
+            shutil.rmtree(path, ignore_errors=True)
+        model = self.load_model(key)
+        return FeatureStore.create(path, model, images, num_images, **kwargs)
+
+    def fit_readout(self, key, data, name, **kwargs):
+        """Fit a new readout on the frozen core of a fitted model.
+
+        The core outputs for the train, validation and test images of data
+        (e.g. a new MultiDataset) are computed once and cached (see
+        feature_store). Masks, feature weights and biases are then trained
+        on these features with the same loss, regularization and early
+        stopping as the full model. name identifies the dataset. Returns
+        the readout model and (num_iterations, val_loss, test_corr).
+        """
+        stores = dict()
+        for split in ['train', 'val', 'test']:
+            images, _ = getattr(data, split)()
+            stores[split] = self.feature_store(key, name + '_' + split, images)
+        log_dir = os.path.join(os.path.dirname(self.checkpoint_file(key)), 'readouts')
+        base = BaseModel(FeatureDataset(data, stores), log_dir=log_dir, log_hash=name)
+        # masks cannot be initialized by STAs of the features
+        readout = self._reg_path_table().build_readout(key, base, init_masks='rand')
+        trainer = Trainer(base, readout)
+        return readout, trainer.fit(**self.fit_kwargs(**kwargs))
+
+    def fit_kwargs(self, **kwargs):
+        """Arguments of Trainer.fit: _fit_kwargs, overridden by kwargs.
+
+        With _checkpoint_in_memory, the best weights are kept in memory
+        during training and written to disk once at the end (see
+        Trainer.fit). Results are the same in both modes. PackedTrainer
+        always keeps them in memory and takes only _fit_kwargs.
+        """
+        return dict(self._fit_kwargs, checkpoint_in_memory=self._checkpoint_in_memory, **kwargs)
+
     def load_model(self, key):
         model = self.get_model(key)
         model.base.tf_session.load()
         return model
+
+    def get_packed_models(self, keys):
+        """Build one model replica per key in a single graph.
+
+        All keys need to share model and dataset, i.e. differ only in their
+        regularization parameters. Returns the shared base, the models and
+        the variable scopes of the replicas.
+        """
+        data = (self._data_table() & keys[0]).load_data()
+        log_dir = os.path.join('checkpoints', self._data_table.database)
+        base = BaseModel(data, log_dir=log_dir, log_hash=self.get_hash(keys[0]),
+                         input_pipeline=self._input_pipeline)
+        models, scopes = [], []
+        for i, key in enumerate(keys):
+            scope = 'replica{:d}'.format(i)
+            with base.tf_session.graph.as_default(), tf.variable_scope(scope):
+                models.append(self._reg_path_table().build_model(key, base))
+            scopes.append(scope)
+        return base, models, scopes
+
+    def initial_values(self, key, data):
+        """Initial values of the model variables as in a regular fit of key.
+
+        The model is built in its own graph, seeded by the key's hash (see
+        TFSession), and initialized. Returns variable name -> value.
+        """
+        base = BaseModel(data, log_hash=self.get_hash(key),
+                         input_pipeline=self._input_pipeline)
+        self._reg_path_table().build_model(key, base)
+        with base.tf_session.graph.as_default():
+            variables = model_variables()
+            base.evaluate(tf.global_variables_initializer())
+            values = base.evaluate(variables)
+        base.tf_session.close()
+        return {v.op.name: value for v, value in zip(variables, values)}
+
+    def _make_tuples_packed(self, keys):
+        base, models, scopes = self.get_packed_models(keys)
+        log_dir = os.path.dirname(base.tf_session.log_dir)
+        log_dirs = [os.path.join(log_dir, self.get_hash(key)) for key in keys]
+        # initialize each replica as a regular fit of its key
+        init_values = [self.initial_values(key, base.data) for key in keys]
+        trainer = PackedTrainer(base, models, scopes, log_dirs, init_values=init_values)
+        results = trainer.fit(**self._fit_kwargs)
+        return [dict(key, num_iterations=num_iterations, val_loss=val_loss, test_corr=test_corr)
+                for key, (num_iterations, val_loss, test_corr) in zip(keys, results)]
+
+    def populate_packed(self, *restrictions, num_replicas=8, suppress_errors=False):
+        """Fit several regularization settings of the same model at once.
+
+        Pending keys that differ only in their regularization seed are
+        trained together in one graph (see PackedTrainer). Keys are reserved
+        in the jobs table before training, so several workers can run this
+        concurrently (see utils.data.populate_reserved). Results are
+        inserted as for regular fits, so models can be loaded as usual.
+        """
+        rel = self.key_source
+        for r in restrictions:
+            rel = rel & r
+        groups = dict()
+        for key in (rel - self).fetch(dj.key):
+            group = tuple((k, v) for k, v in sorted(key.items()) if k != 'reg_seed')
+            groups.setdefault(group, []).append(key)
+        groups = list(groups.values())
+        random.shuffle(groups)
+        for keys in groups:
+            for i in range(0, len(keys), num_replicas):
+                populate_reserved(self, keys[i:i+num_replicas], self._make_tuples_packed,
+                                  suppress_errors)
@@ -16,6 +16,12 @@ class Model(Config):
         part = getattr(self, the_type)
         return part().build(key, base, regularization_parameters)
 
+    def build_readout(self, key, base, regularization_parameters, **kwargs):
+        type_name = self._type + '_type'
+        the_type = (self & key).fetch1(type_name)
+        part = getattr(self, the_type)
+        return part().build_readout(key, base, regularization_parameters, **kwargs)
+
 
 class Component(Config):
     """Abstract base class for definition of a type of model components.
@@ -28,8 +34,8 @@ class Component(Config):
         p = (self * part).fetch1()
         return part.decode_params_from_db(p)
 
-    def build(self, key, base, inputs, regularization_parameters):
-        parameters = self.parameters(key)
+    def build(self, key, base, inputs, regularization_parameters, **kwargs):
+        parameters = dict(self.parameters(key), **kwargs)
         the_type = parameters.pop(self._type + '_type')
         part = getattr(self, the_type)
         class_name = part().class_name + self._type.title()
@@ -77,3 +83,13 @@ class CorePlusReadout:
         readout_key = (self * self._readout_table() & key).fetch1(dj.key)
         readout = self._readout_table().build(readout_key, base, core.output, regularization_parameters)
         return models.CorePlusReadoutModel(base, core, readout)
+
+    def build_readout(self, key, base, regularization_parameters, **kwargs):
+        """Readout only, on base.inputs (core outputs instead of images).
+
+        kwargs override the stored readout parameters.
+        """
+        readout_key = (self * self._readout_table() & key).fetch1(dj.key)
+        readout = self._readout_table().build(
+            readout_key, base, base.inputs, regularization_parameters, **kwargs)
+        return models.ReadoutModel(base, readout)
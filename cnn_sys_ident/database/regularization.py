@@ -117,13 +117,20 @@ class RegPath(Messager):
             if isclass(getattr(self, member)) and issubclass(getattr(self, member), dj.Part):
                 yield getattr(self, member)
 
-    def build_model(self, key, base):
+    def regularization_parameters(self, key):
         reg_params = dict()
         for part in self.parts:
             if len(part() & key):
                 p = (part() & key).fetch1()
                 reg_params = dict(reg_params, **p)
-        return self._model_table().build(key, base, reg_params)
+        return reg_params
+
+    def build_model(self, key, base):
+        return self._model_table().build(key, base, self.regularization_parameters(key))
+
+    def build_readout(self, key, base, **kwargs):
+        reg_params = self.regularization_parameters(key)
+        return self._model_table().build_readout(key, base, reg_params, **kwargs)
 
     def _make_tuples(self, key):
         print(key)
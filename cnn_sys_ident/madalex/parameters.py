@@ -139,10 +139,10 @@ class Fit(fit.Fit, dj.Computed):
     _data_table = MultiDataset
 
     def _make_tuples(self, key):
-        model = self.get_model(key)
+        model = self.get_model(key, input_pipeline=self._input_pipeline)
         trainer = Trainer(model.base, model)
         tupl = key
         tupl['num_iterations'], tupl['val_loss'], tupl['test_corr'] = trainer.fit(
-            val_steps=50, learning_rate=0.002, batch_size=256, patience=5)
+            **self.fit_kwargs(val_steps=50, learning_rate=0.002, batch_size=256, patience=5))
         self.insert1(tupl)
 
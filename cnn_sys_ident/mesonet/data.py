@@ -5,14 +5,24 @@ import h5py
 import datajoint as dj
 import numpy as np
 
+from ..utils.cache import cache_path, save_arrays, load_arrays, writing, evict
+from ..utils.dataset import LazyDataset, normalization
+
 
 schema = dj.schema('aecker_mesonet_data', locals())
 
 PATH = os.path.dirname(os.path.dirname(os.path.dirname(inspect.stack()[0][1])))
 DATA_PATH = os.path.join(PATH, 'data/mesonet')
+LAZY_DATA_PATH = os.path.join(DATA_PATH, 'lazy')
 
 
 class Dataset:
+    _arrays = ['images_train', 'images_val', 'images_test',
+               'responses_train', 'responses_val', 'responses_test']
+
+    # increase when changing the preprocessing (invalidates cached datasets)
+    version = 1
+
     def __init__(self,
                  images_train,
                  responses_train,
@@ -38,15 +48,29 @@ class Dataset:
         self.responses_train = rectify_and_normalize(responses_train)
         self.responses_val = rectify_and_normalize(responses_val)
         self.responses_test = rectify_and_normalize(responses_test)
-        
-        self.num_neurons = responses_train.shape[1]
-        self.num_train_samples = images_train.shape[0]
-        self.px_x = images_train.shape[2]
-        self.px_y = images_train.shape[1]
+        self._set_dims()
+
+    def _set_dims(self):
+        self.num_neurons = self.responses_train.shape[1]
+        self.num_train_samples = self.images_train.shape[0]
+        self.px_x = self.images_train.shape[2]
+        self.px_y = self.images_train.shape[1]
         self.input_shape = [None, self.px_y, self.px_x, 1]
         self.minibatch_idx = 1e10
         self.train_perm = []
 
+    def arrays(self):
+        return {name: getattr(self, name) for name in self._arrays}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Dataset from already normalized arrays (see arrays())."""
+        data = cls.__new__(cls)
+        for name in cls._arrays:
+            setattr(data, name, arrays[name])
+        data._set_dims()
+        return data
+
     def val(self):
         return self.images_val, self.responses_val
 
@@ -238,8 +262,31 @@ class MultiDataset(dj.Lookup):
                     self.Unit().insert(units)
 
 
-    def load_data(self):
+    def load_data(self, cache=True, lazy=False):
+        """Load dataset.
+
+        With cache=True, the preprocessed arrays are stored in a cache on
+        disk (see utils.cache) keyed by data_hash and Dataset.version. All
+        workers share one read-only, memory-mapped copy. Least recently used
+        datasets are deleted when the cache exceeds its size limit.
+
+        With lazy=True, a LazyDataset is returned instead. Its raw arrays are
+        kept on disk (LAZY_DATA_PATH) and written one member at a time, so
+        the dataset never has to fit into memory.
+        """
         assert len(self) == 1, 'Relation must be scalar.'
+        if lazy:
+            path = os.path.join(LAZY_DATA_PATH, self.fetch1('data_hash'))
+            if not os.path.isdir(path):
+                self._write_raw(path)
+            return LazyDataset(path)
+        path = cache_path(schema.database,
+                          '{}-v{:d}'.format(self.fetch1('data_hash'), Dataset.version))
+        if cache and os.path.isdir(path):
+            try:
+                return Dataset.from_arrays(load_arrays(path, touch=True))
+            except FileNotFoundError:
+                pass  # evicted by another worker in the meantime
         
         data = []
         for key in (self * self.Member()).fetch(dj.key, order_by='member_id'):
@@ -251,4 +298,36 @@ class MultiDataset(dj.Lookup):
             else:
                 return data[0][k]
 
-        return Dataset(*[merge(i) for i in range(6)])
+        data = Dataset(*[merge(i) for i in range(6)])
+        if cache:
+            save_arrays(path, **data.arrays())
+            evict(os.path.dirname(path), keep=path)
+            try:
+                return Dataset.from_arrays(load_arrays(path))
+            except FileNotFoundError:
+                return data
+        return data
+
+    def _write_raw(self, path):
+        splits = ['train', 'val', 'test']
+        num_neurons = len(self.Unit() & self)
+        with writing(path) as tmp:
+            responses = dict()
+            n = 0
+            for key in (self * self.Member()).fetch(dj.key, order_by='member_id'):
+                data = (Area() & (self.Member() & key)).load_files()
+                for i, split in enumerate(splits):
+                    images, res = data[2*i], data[2*i+1]
+                    if not n:
+                        np.save(os.path.join(tmp, 'images_' + split + '.npy'), images)
+                        responses[split] = np.lib.format.open_memmap(
+                            os.path.join(tmp, 'responses_' + split + '.npy'), mode='w+',
+                            dtype=res.dtype, shape=res.shape[:-1] + (num_neurons,))
+                    responses[split][...,n:n+res.shape[-1]] = res
+                n += data[1].shape[-1]
+            for res in responses.values():
+                res.flush()
+            images_train = np.load(os.path.join(tmp, 'images_train.npy'), mmap_mode='r')
+            for name, array in normalization(images_train, responses['train']).items():
+                np.save(os.path.join(tmp, name + '.npy'), array)
+            del responses
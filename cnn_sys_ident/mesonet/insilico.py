@@ -1,15 +1,21 @@
 import numpy as np
+import tensorflow as tf
 import datajoint as dj
 from itertools import product
 
 from .parameters import Fit
 from .data import MultiDataset
 from . import MODELS
-from ..utils.stimuli import GaborSet
+from ..utils.stimuli import GaborSet, coarse_to_fine_search, coarse_grid, top_candidates
+from ..utils.insilico import TranslationSweep, PlaidTuning
+from ..utils.mei import GaborFit
+from ..utils.cache import STIMULUS_CACHE
 
 schema = dj.schema('aecker_mesonet_insilico', locals())
 
 BATCH_SIZE = 1024
+NUM_WORKERS = 4
+SWEEP_BATCH_SIZE = 8
 
 
 @schema
@@ -93,13 +99,20 @@ class OptimalGabor(dj.Computed):
         key = (Fit() * model_rel).fetch(dj.key, order_by='val_loss', limit=1)[0]
         return Fit() * GaborParams() & key
 
+    # use the translation shortcut (see _make_tuples_translated)
+    _translation_sweep = False
+
     def _make_tuples(self, key):
+        if self._translation_sweep:
+            return self._make_tuples_translated(key)
         model = Fit().load_model(key)
         s = model.base.inputs.shape.as_list()
         canvas_size = [s[2], s[1]]
         g = GaborParams().gabor_set(key, canvas_size)
         max_response, max_idx = 0, 0
-        for batch_idx, images in enumerate(g.image_batches(BATCH_SIZE)):
+        batches = g.image_batches(BATCH_SIZE, num_workers=NUM_WORKERS, dtype=np.float32,
+                                  cache=STIMULUS_CACHE)
+        for batch_idx, images in enumerate(batches):
             feed_dict = {model.base.inputs: images[...,None],
                          model.base.is_training: False}
             r = model.base.evaluate(model.predictions, feed_dict=feed_dict)
@@ -118,6 +131,239 @@ class OptimalGabor(dj.Computed):
                                             max_idx)]
         self.Unit().insert(tuples)
 
+    def _make_tuples_translated(self, key, num_candidates=4):
+        """Search the Gabor grid running the core once for all locations.
+
+        Responses for all locations are obtained from a TranslationSweep.
+        With SAME padding these are wrong for stimuli that reach the image
+        border if the unit's mask has weight within the receptive field
+        radius of that border (see TranslationSweep.border_units and
+        GaborSet.border_sides). These stimuli are excluded from the sweep
+        for the affected units and all of them are evaluated with the full
+        network instead, so the search is exhaustive up to the tolerances
+        of these two functions. Finally, the num_candidates best stimuli of
+        each unit are re-evaluated with the full network and the best one
+        is stored.
+        """
+        model = Fit().load_model(key)
+        s = model.base.inputs.shape.as_list()
+        canvas_size = [s[2], s[1]]
+        g = GaborParams().gabor_set(key, canvas_size)
+        sweep = g.location_sweep()
+        num_sweep = np.prod(sweep.num_params)
+        num_per_size = np.prod(sweep.num_params[2:])
+        num_locations = g.num_params[0]
+        cr = g.center_range
+        worker = TranslationSweep(model.base.tf_session.graph, Fit().checkpoint_file(key),
+                                  model, canvas_size, [cr[1] - cr[0], cr[3] - cr[2]])
+
+        def evaluate(idx):
+            r = []
+            for batch_start in range(0, len(idx), BATCH_SIZE):
+                images = g.gabors(idx[batch_start:batch_start+BATCH_SIZE])
+                feed_dict = {model.base.inputs: images[...,None],
+                             model.base.is_training: False}
+                r.append(model.base.evaluate(model.predictions, feed_dict=feed_dict))
+            return np.concatenate(r, axis=0)
+
+        # stimuli not covered by the sweep: [sizes, locations, units]
+        affected = np.einsum('lsb,ub->slu', g.border_sides().astype(int),
+                             worker.border_units().astype(int)) > 0
+
+        # running top candidates per unit
+        num_units = model.predictions.shape.as_list()[1]
+        top_r, top_idx = None, None
+        batches = sweep.image_batches(SWEEP_BATCH_SIZE, num_workers=NUM_WORKERS, dtype=np.float32,
+                                      cache=STIMULUS_CACHE)
+        for batch_idx, images in enumerate(batches):
+            i = batch_idx * SWEEP_BATCH_SIZE + np.arange(len(images))
+            r = worker.evaluate(images[...,None])
+            r = np.where(affected[i // num_per_size], -np.inf, r).reshape([-1, num_units])
+            idx = (i[:,None] + num_sweep * np.arange(num_locations)).ravel()
+            top_r, top_idx = top_candidates(top_r, top_idx, r, idx, num_candidates)
+            if not (batch_idx % 100):
+                print(batch_idx, top_r.max(axis=0).mean())
+
+        # border stimuli of affected units with the full network
+        size_idx, loc_idx = np.where(affected.any(axis=2))
+        idx = (num_sweep * loc_idx[:,None] + num_per_size * size_idx[:,None] + \
+               np.arange(num_per_size)).ravel()
+        print('Evaluating {:d} border stimuli with the full network'.format(len(idx)))
+        for batch_start in range(0, len(idx), BATCH_SIZE):
+            batch = idx[batch_start:batch_start+BATCH_SIZE]
+            c = np.unravel_index(batch, g.num_params)
+            r = np.where(affected[c[1], c[0]], evaluate(batch), -np.inf)
+            top_r, top_idx = top_candidates(top_r, top_idx, r, batch, num_candidates)
+
+        # verify candidates with the full network
+        candidates = np.unique(top_idx)
+        r = evaluate(candidates)
+        units = np.arange(num_units)
+        r = r[np.searchsorted(candidates, top_idx), units]
+        best = r.argmax(axis=0)
+        max_response = r[best, units]
+        max_idx = top_idx[best, units]
+
+        self.insert1(key)
+        tuples = [dict(key, unit_id=id, max_response=mr, max_index=mi)
+                      for id, mr, mi in zip(units, max_response, max_idx)]
+        self.Unit().insert(tuples)
+
+
+@schema
+class AdaptiveGaborParams(dj.Lookup):
+    definition = """
+        adaptive_id     : tinyint unsigned  # id for search parameters
+        ---
+        num_candidates  : tinyint unsigned  # candidates refined per unit
+        coarse_size     : tinyint unsigned  # samples per axis in coarse grid
+        max_stimuli     : int unsigned      # budget (number of stimuli)
+        """
+
+    contents = [
+        [1, 8, 3, 500000],
+    ]
+
+
+@schema
+class OptimalGaborAdaptive(dj.Computed):
+    definition = """
+        -> GaborParams
+        -> AdaptiveGaborParams
+        -> Fit
+        ---
+        num_evaluated : int unsigned  # number of stimuli evaluated
+        """
+
+    class Unit(dj.Part):
+        definition = """
+            -> master
+            -> MultiDataset.Unit
+            ---
+            max_response : float  # response to optimal Gabor
+            max_index    : int    # index of optimal Gabor (as in OptimalGabor)
+            """
+
+        def params(self, key):
+            gabor_set = GaborParams().gabor_set(key, None)
+            idx = (self & key).fetch1('max_index')
+            return gabor_set.params_from_idx(idx)
+
+    @property
+    def key_source(self):
+        return OptimalGabor().key_source * AdaptiveGaborParams()
+
+    def _make_tuples(self, key):
+        model = Fit().load_model(key)
+        s = model.base.inputs.shape.as_list()
+        canvas_size = [s[2], s[1]]
+        g = GaborParams().gabor_set(key, canvas_size)
+        num_candidates, coarse_size, max_stimuli = (AdaptiveGaborParams() & key).fetch1(
+            'num_candidates', 'coarse_size', 'max_stimuli')
+
+        def evaluate(images):
+            feed_dict = {model.base.inputs: images[...,None],
+                         model.base.is_training: False}
+            return model.base.evaluate(model.predictions, feed_dict=feed_dict)
+
+        max_response, max_idx, num_evaluated = coarse_to_fine_search(
+            g, evaluate, num_candidates=num_candidates, coarse_size=coarse_size,
+            max_stimuli=max_stimuli, batch_size=BATCH_SIZE)
+        print('Evaluated {:d} of {:d} stimuli'.format(num_evaluated, np.prod(g.num_params)))
+
+        self.insert1(dict(key, num_evaluated=num_evaluated))
+        tuples = [dict(key, unit_id=id, max_response=mr, max_index=mi)
+                      for id, mr, mi in zip(np.arange(len(max_idx)),
+                                            max_response,
+                                            max_idx)]
+        self.Unit().insert(tuples)
+
+
+@schema
+class GaborFitParams(dj.Lookup):
+    definition = """
+        fit_param_id    : tinyint unsigned  # id for optimization parameters
+        ---
+        num_starts      : tinyint unsigned  # starting points per unit
+        coarse_size     : tinyint unsigned  # samples per axis in coarse grid
+        num_steps       : smallint unsigned # number of gradient steps
+        learning_rate   : float             # learning rate (Adam)
+        """
+
+    contents = [
+        [1, 8, 3, 300, 0.05],
+    ]
+
+
+@schema
+class OptimalGaborFit(dj.Computed):
+    definition = """
+        -> GaborParams
+        -> GaborFitParams
+        -> Fit
+        ---
+        """
+
+    class Unit(dj.Part):
+        definition = """
+            -> master
+            -> MultiDataset.Unit
+            ---
+            max_response      : float  # response to optimal Gabor
+            x                 : float  # location (x)
+            y                 : float  # location (y)
+            size              : float  # size (+/- 2 SD of envelope)
+            spatial_frequency : float  # spatial frequency (cycles / pixel)
+            contrast          : float  # contrast (Michelson)
+            orientation       : float  # orientation [0, pi)
+            phase             : float  # phase [0, 2*pi)
+            """
+
+    _units_per_fit = 64
+
+    @property
+    def key_source(self):
+        return OptimalGabor().key_source * GaborFitParams()
+
+    def _make_tuples(self, key):
+        model = Fit().load_model(key)
+        s = model.base.inputs.shape.as_list()
+        canvas_size = [s[2], s[1]]
+        g = GaborParams().gabor_set(key, canvas_size)
+        p = (GaborFitParams() & key).fetch1()
+
+        # starting points: best stimuli of each unit on a coarse grid
+        idx, _ = coarse_grid(g, p['coarse_size'])
+        top_r, top_idx = None, None
+        for batch_start in range(0, len(idx), BATCH_SIZE):
+            i = idx[batch_start:batch_start+BATCH_SIZE]
+            feed_dict = {model.base.inputs: g.gabors(i)[...,None],
+                         model.base.is_training: False}
+            r = model.base.evaluate(model.predictions, feed_dict=feed_dict)
+            top_r, top_idx = top_candidates(top_r, top_idx, r, i, p['num_starts'])
+        loc, size, sf, contrast, ori, phase = g.params_from_idx(top_idx.T)
+        init = np.concatenate([loc, np.stack([size, sf, contrast, ori, phase], axis=2)], axis=2)
+
+        worker = GaborFit.cached(
+            lambda: model.base.tf_session.graph, Fit().checkpoint_file(key), canvas_size,
+            g.bounds(), self._units_per_fit, p['num_starts'], g.relative_sf)
+        num_units = len(init)
+        params, max_response = [], []
+        for start in range(0, num_units, self._units_per_fit):
+            # pad last block to the fixed number of units
+            units = np.minimum(np.arange(start, start + self._units_per_fit), num_units - 1)
+            params_i, response_i = worker.fit(units, init[units], p['learning_rate'], p['num_steps'])
+            params.append(params_i)
+            max_response.append(response_i)
+            print('Unit {:d}'.format(start))
+        params = np.concatenate(params)[:num_units]
+        max_response = np.concatenate(max_response)[:num_units]
+
+        self.insert1(key)
+        names = ['x', 'y', 'size', 'spatial_frequency', 'contrast', 'orientation', 'phase']
+        tuples = [dict(key, unit_id=id, max_response=mr, **dict(zip(names, pi)))
+                      for id, mr, pi in zip(np.arange(num_units), max_response, params)]
+        self.Unit().insert(tuples)
 
 
 @schema
@@ -137,6 +383,12 @@ class SizeContrastTuningParams(dj.Lookup):
         [1, 8, 12, 1.2, 2**-3.5, 12, np.sqrt(2)]
     ]
 
+    def sizes_contrasts(self, key):
+        p = (self & key).fetch1()
+        sizes = p['min_size'] * p['size_increment'] ** np.arange(p['num_sizes'])
+        c = p['min_contrast'] * p['contrast_increment'] ** np.arange(p['num_contrasts'])
+        return sizes, c
+
     def gabor_set(self, key, canvas_size, loc, spatial_freq, orientation, phase):
         p = (self & key).fetch1()
         center_range = [loc[0], loc[0]+1, loc[1], loc[1]+1]
@@ -165,17 +417,39 @@ class SizeContrastTuning(dj.Computed):
         model = Fit().load_model(key)
         s = model.base.inputs.shape.as_list()
         canvas_size = [s[2], s[1]]
+        sizes, contrasts = SizeContrastTuningParams().sizes_contrasts(key)
+        num_stims = len(sizes) * len(contrasts)
+
+        # optimal Gabors of all units
+        unit_ids, max_idx = (OptimalGabor.Unit() & key).fetch(
+            'unit_id', 'max_index', order_by='unit_id')
+        loc, _, sf, _, ori, ph = GaborParams().gabor_set(key, None).params_from_idx(max_idx)
+
+        # stimuli of all units (unit x size x contrast) in mixed batches
+        g = GaborSet(canvas_size, [0, 1, 0, 1], sizes, [0], contrasts, [0], [0])  # only renders
+        with model.base.tf_session.graph.as_default():
+            units = tf.placeholder(tf.int32, shape=[None], name='units')
+        predictions = model.unit_predictions(units, paired=True)
+        size, contrast = np.divmod(np.arange(num_stims), len(contrasts))
+        ones = np.ones(num_stims)
+        units_per_batch = max(1, BATCH_SIZE // num_stims)
+        tuning_curves = []
+        for batch_start in range(0, len(unit_ids), units_per_batch):
+            u = np.arange(batch_start, min(batch_start + units_per_batch, len(unit_ids)))
+            images = np.concatenate([
+                g.render(np.tile(loc[i], [num_stims, 1]), sizes[size], sf[i] * ones,
+                         contrasts[contrast], ori[i] * ones, ph[i] * ones)
+                for i in u])
+            feed_dict = {model.base.inputs: images[...,None],
+                         model.base.is_training: False,
+                         units: np.repeat(unit_ids[u], num_stims)}
+            tuning_curves.append(model.base.evaluate(predictions, feed_dict=feed_dict))
+        tuning_curves = np.concatenate(tuning_curves)
+        tuning_curves = tuning_curves.reshape([len(unit_ids), len(sizes), len(contrasts)])
+
         self.insert1(key)
-        for key in (OptimalGabor.Unit() & key).fetch(dj.key):
-            loc, _, sf, _, ori, ph = OptimalGabor.Unit().params(key)
-            g = SizeContrastTuningParams().gabor_set(key, canvas_size, loc, sf, ori, ph)
-            feed_dict = {model.base.inputs: g.images()[...,None],
-                         model.base.is_training: False}
-            tupl = key
-            pred = model.base.evaluate(model.predictions, feed_dict=feed_dict)
-            tupl['tuning_curve'] = pred[:,key['unit_id']].reshape([len(g.sizes), len(g.contrasts)])
-            self.Unit.insert1(tupl)
-            print(key['unit_id'])
+        self.Unit().insert([dict(key, unit_id=id, tuning_curve=t)
+                            for id, t in zip(unit_ids, tuning_curves)])
 
 
 @schema
@@ -223,26 +497,44 @@ class OrthPlaidsContrast(dj.Computed):
             tuning_curve  : blob  # contrast preferred x contrast orthogonal
         """
 
+    _units_per_run = 16
+
     def _make_tuples(self, key):
-        model = Fit().load_model(key)
+        model = Fit().get_model(key)
         s = model.base.inputs.shape.as_list()
         canvas_size = [s[2], s[1]]
         contrasts = OrthPlaidsContrastParams().contrasts(key)
-        key.update(contrasts=contrasts)
-        self.insert1(key)
-        for i, key in enumerate((OptimalGabor.Unit() & key).fetch(dj.key)):
-            loc, sz, sf, _, ori, ph = OptimalGabor.Unit().params(key)
-            g_pref = OrthPlaidsContrastParams().gabor_set(key, canvas_size, loc, sz, sf, ori, ph)
-            g_orth = OrthPlaidsContrastParams().gabor_set(key, canvas_size, loc, sz, sf, ori + np.pi/2, ph)
-            comps_pref = g_pref.images()
-            comps_orth = g_orth.images()
-            plaids = comps_pref[None,...] + comps_orth[:,None,...]
-            plaids = np.reshape(plaids, [-1] + s[1:])
-            feed_dict = {model.base.inputs: plaids,
-                         model.base.is_training: False}
-            tuning_curve = model.base.evaluate(model.predictions[:,key['unit_id']], feed_dict=feed_dict)
-            tupl = key
-            tupl['tuning_curve'] = tuning_curve.reshape([len(contrasts), len(contrasts)])
-            self.Unit.insert1(tupl)
-            if not (i % 10):
-                print('Unit {:d}'.format(i))
+        num_contrasts = len(contrasts)
+
+        # optimal Gabors of all units
+        unit_ids, max_idx = (OptimalGabor.Unit() & key).fetch(
+            'unit_id', 'max_index', order_by='unit_id')
+        loc, sz, sf, _, ori, ph = GaborParams().gabor_set(key, None).params_from_idx(max_idx)
+
+        # components are fed per unit, plaids are composed in the graph
+        num_units = self._units_per_run
+        worker = PlaidTuning(model.base.tf_session.graph, Fit().checkpoint_file(key), model,
+                             canvas_size, num_units, num_contrasts)
+        g = GaborSet(canvas_size, [0, 1, 0, 1], [0], [0], contrasts, [0], [0])  # only renders
+        shape = [num_units, num_contrasts, s[1], s[2]]
+        ones = np.ones(num_contrasts)
+
+        def components(i):
+            params = [np.tile(loc[i], [num_contrasts, 1]), sz[i] * ones, sf[i] * ones, contrasts]
+            comps_pref = g.render(*params, ori[i] * ones, ph[i] * ones)
+            comps_orth = g.render(*params, (ori[i] + np.pi/2) * ones, ph[i] * ones)
+            return comps_pref, comps_orth
+
+        tuning_curves = []
+        for start in range(0, len(unit_ids), num_units):
+            # pad last block to the fixed number of units
+            u = np.minimum(np.arange(start, start + num_units), len(unit_ids) - 1)
+            comps_pref, comps_orth = zip(*[components(i) for i in u])
+            tuning_curves.append(worker.evaluate(
+                unit_ids[u], np.reshape(comps_pref, shape), np.reshape(comps_orth, shape)))
+            print('Unit {:d}'.format(start))
+        tuning_curves = np.concatenate(tuning_curves)[:len(unit_ids)]
+
+        self.insert1(dict(key, contrasts=contrasts))
+        self.Unit().insert([dict(key, unit_id=id, tuning_curve=t)
+                            for id, t in zip(unit_ids, tuning_curves)])
@@ -198,13 +198,16 @@ class RegPath(reg.RegPath, dj.Computed):
 class Fit(fit.Fit, dj.Computed):
     _reg_path_table = RegPath
     _data_table = MultiDataset
+    _input_pipeline = True
+    _checkpoint_in_memory = True
+    _fit_kwargs = dict(val_steps=50, learning_rate=0.002, batch_size=256, patience=5)
     
     def _make_tuples(self, key):
-        model = self.get_model(key)
+        model = self.get_model(key, input_pipeline=self._input_pipeline)
         trainer = Trainer(model.base, model)
         tupl = key
         tupl['num_iterations'], tupl['val_loss'], tupl['test_corr'] = trainer.fit(
-            val_steps=50, learning_rate=0.002, batch_size=256, patience=5)
+            **self.fit_kwargs())
         self.insert1(tupl)
 
     def _make_tuples_from_checkpoints(self, key):
@@ -222,11 +225,7 @@ class Fit(fit.Fit, dj.Computed):
             trainer = Trainer(model.base, model)
             tupl = key
             tupl['num_iterations'] = 0
-            inputs_val, res_val = trainer.data.val()
-            feed_dict_val = {trainer.base.inputs: inputs_val,
-                             trainer.base.responses: res_val,
-                             trainer.base.is_training: False}
-            tupl['val_loss'] = trainer.session.run(trainer.poisson, feed_dict_val)
+            tupl['val_loss'], _ = trainer.evaluate('val')
             tupl['test_corr'] = trainer.compute_test_corr()
             self.insert1(tupl)
 
@@ -1,9 +1,9 @@
 import datajoint as dj
-import os
 
 from .data import MultiDataset
 from .parameters import Fit
-from ..utils.mei import ActivityMaximization
+from ..utils.mei import ActivityMaximization, GradientRF
+from ..utils.data import populate_reserved
 from . import MODELS
 
 schema = dj.schema('aecker_mesonet_vis', locals())
@@ -52,26 +52,90 @@ class MEI(dj.Computed):
     """
 
     def _make_tuples(self, key):
-        net = Fit().get_model(key)
+        self.insert(self.make_batch([key]))
+
+    def make_batch(self, keys, num_units=None):
+        """Compute MEIs for several units of the same model at once.
+
+        num_units fixes the number of unit slots of the (cached) graph, so
+        smaller batches reuse it.
+        """
+        key = keys[0]
         image_norm, smoothness = (MEIParams() & key).fetch1(
             'image_norm', 'smoothness')
-        unit_id = key['unit_id']
-        print(unit_id)
-
-        tfs = net.base.tf_session
-        checkpoint_file = os.path.join(tfs.log_dir, 'model.ckpt')
-        shape = [net.base.data.input_shape[1], net.base.data.input_shape[2]]
-        worker = ActivityMaximization(
-            tfs.graph, checkpoint_file, shape, unit_id, smoothness, image_norm, num_images=8)
+        unit_ids = [k['unit_id'] for k in keys]
+        print(unit_ids)
+
+        def get_graph():
+            net = Fit().get_model(key)
+            shape = [net.base.data.input_shape[1], net.base.data.input_shape[2]]
+            return net.base.tf_session.graph, shape
+
+        worker = ActivityMaximization.cached(
+            get_graph, Fit().checkpoint_file(key), unit_ids, smoothness, image_norm,
+            num_images=8, num_units=num_units)
         images, rates, loss = worker.maximize(max_iter=2000, learning_rate=1.0)
         print('Done after {:d} iterations (max rate = {:.2f})'.format(len(loss), rates.max()))
 
-        tupl = key
-        tupl['unit_id'] = unit_id
-        tupl['max_rate'] = rates.max()
-        idx = rates.argmax()
-        tupl['max_image'] = images[idx,:,:,0]
-        tupl['avg_rate'] = rates.mean()
-        tupl['rates'] = rates
-        tupl['images'] = images[:,:,:,0]
-        self.insert1(tupl)
+        tuples = []
+        for k, unit_images, unit_rates in zip(keys, images, rates):
+            tupl = dict(k)
+            tupl['max_rate'] = unit_rates.max()
+            idx = unit_rates.argmax()
+            tupl['max_image'] = unit_images[idx,:,:,0]
+            tupl['avg_rate'] = unit_rates.mean()
+            tupl['rates'] = unit_rates
+            tupl['images'] = unit_images[:,:,:,0]
+            tuples.append(tupl)
+        return tuples
+
+    def populate_batched(self, *restrictions, batch_size=100, suppress_errors=False):
+        """Compute MEIs for up to batch_size units of a model per job.
+
+        Keys are reserved in the jobs table, so several workers can run this
+        concurrently (see utils.data.populate_reserved).
+        """
+        rel = self.key_source
+        for r in restrictions:
+            rel = rel & r
+        groups = dict()
+        for key in (rel - self).fetch(dj.key):
+            group = tuple((k, v) for k, v in sorted(key.items()) if k != 'unit_id')
+            groups.setdefault(group, []).append(key)
+        for keys in groups.values():
+            for i in range(0, len(keys), batch_size):
+                populate_reserved(self, keys[i:i+batch_size],
+                                  lambda keys: self.make_batch(keys, batch_size),
+                                  suppress_errors)
+
+
+@schema
+class GradientReceptiveField(dj.Computed):
+    definition = """  # gradient receptive fields for all cells
+    -> Fit
+    """
+
+    class Unit(dj.Part):
+        definition = """
+            -> master
+            -> MultiDataset.Unit
+            ---
+            gradient_rf   : blob        # gradient of rate w.r.t. blank image
+            """
+
+    @property
+    def key_source(self):
+        return Fit() & MEIGroup()
+
+    def _make_tuples(self, key):
+        def get_graph():
+            net = Fit().get_model(key)
+            shape = [net.base.data.input_shape[1], net.base.data.input_shape[2]]
+            return net.base.tf_session.graph, shape
+
+        worker = GradientRF.cached(get_graph, Fit().checkpoint_file(key))
+        unit_keys = (MultiDataset.Unit() & key).fetch(dj.key, order_by='unit_id')
+        rfs = worker.gradients([k['unit_id'] for k in unit_keys])
+
+        self.insert1(key)
+        self.Unit().insert([dict(key, **k, gradient_rf=rf) for k, rf in zip(unit_keys, rfs)])
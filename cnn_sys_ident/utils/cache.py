@@ -0,0 +1,187 @@
+import os
+import shutil
+import tempfile
+import hashlib
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+
+# cache of preprocessed datasets (node-local temporary directory by default)
+CACHE_DIR = os.environ.get(
+    'CNN_SYS_IDENT_CACHE', os.path.join(tempfile.gettempdir(), 'cnn_sys_ident'))
+CACHE_BYTES = int(os.environ.get('CNN_SYS_IDENT_CACHE_MB', 2**16)) * 2**20
+
+# stimulus cache on disk (node-local temporary directory by default); the
+# full Gabor grid does not fit, so only a prefix of it is cached (see
+# GaborSet.image_batches)
+STIMULUS_CACHE_DIR = os.environ.get(
+    'CNN_SYS_IDENT_STIMULUS_CACHE', os.path.join(CACHE_DIR, 'stimuli'))
+STIMULUS_CACHE_BYTES = int(os.environ.get('CNN_SYS_IDENT_STIMULUS_CACHE_MB', 2**13)) * 2**20
+
+
+def cache_path(*keys):
+    return os.path.join(CACHE_DIR, *map(str, keys))
+
+
+@contextmanager
+def writing(path):
+    """Temporary directory for a new cache entry, moved to path when done.
+
+    Entries are written under a temporary name and renamed when complete,
+    so concurrent workers never see partial entries. If another worker
+    created the entry in the meantime, its copy is kept.
+    """
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        yield tmp
+        os.rename(tmp, path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def evict(parent, max_bytes=CACHE_BYTES, keep=None):
+    """Delete least recently used entries (directories) of parent.
+
+    Entries are deleted by modification time (see load_arrays(touch=True))
+    until the total size is at most max_bytes. The entry keep (e.g. the one
+    just written) is never deleted. Workers that memory-mapped a deleted
+    entry keep reading their copy; other workers have to handle a
+    FileNotFoundError when loading an entry.
+    """
+    entries = []
+    for name in os.listdir(parent):
+        path = os.path.join(parent, name)
+        if name.startswith('.tmp-') or path == keep:
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        except (FileNotFoundError, NotADirectoryError):
+            continue  # not an entry or deleted by another worker
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def save_arrays(path, **arrays):
+    """Write arrays as .npy files into directory path (see writing())."""
+    with writing(path) as tmp:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), array)
+
+
+def load_arrays(path, mmap_mode='r', touch=False):
+    """Load all arrays in directory path (memory-mapped by default).
+
+    With touch=True, the entry is marked as recently used (see evict).
+    """
+    if touch:
+        os.utime(path)
+    arrays = dict()
+    for file_name in os.listdir(path):
+        name, ext = os.path.splitext(file_name)
+        if ext == '.npy':
+            arrays[name] = np.load(os.path.join(path, file_name), mmap_mode=mmap_mode)
+    return arrays
+
+
+def array_key(*values):
+    """Content hash of a tuple of parameters (numbers, arrays or strings)."""
+    hashed = hashlib.md5()
+    for v in values:
+        if isinstance(v, str):
+            hashed.update(v.encode())
+        else:
+            v = np.asarray(v, dtype=np.float64)
+            hashed.update(str(v.shape).encode())
+            hashed.update(v.tobytes())
+        hashed.update(b'|')
+    return hashed.hexdigest()
+
+
+class StimulusCache:
+    """Content-addressed cache of rendered stimuli.
+
+    Each entry is a .npy file named by a key (see array_key) and is read
+    back memory-mapped, i.e. without copying. Files are written under a
+    temporary name and renamed, so concurrent workers can share the cache.
+    When the cache grows beyond max_bytes, the least recently used entries
+    are deleted.
+    """
+    def __init__(self, path=None, max_bytes=STIMULUS_CACHE_BYTES):
+        self.path = STIMULUS_CACHE_DIR if path is None else path
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()  # entries are written by renderer threads
+
+    def get(self, key, render):
+        """Array stored under key, computed by render() if missing."""
+        file_name = os.path.join(self.path, key[:2], key + '.npy')
+        try:
+            array = np.load(file_name, mmap_mode='r')
+            os.utime(file_name)
+            return array
+        except FileNotFoundError:
+            pass
+        array = render()
+        self._write(file_name, array)
+        return array
+
+    def _write(self, file_name, array):
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file_name), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array)
+                size = f.tell()
+            with self._lock:
+                if self._size is None:
+                    self._size = sum(s for _, s, _ in self._entries())
+                os.rename(tmp, file_name)
+                self._size += size
+                if self._size > self.max_bytes:
+                    self._evict(self.max_bytes)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def evict(self, max_bytes=None):
+        """Delete least recently used entries down to 90% of max_bytes."""
+        with self._lock:
+            self._evict(self.max_bytes if max_bytes is None else max_bytes)
+
+    def _evict(self, max_bytes):
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, file_name in entries:
+            if self._size <= 0.9 * max_bytes:
+                break
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+    def _entries(self):
+        # (last access, size, file) of all entries
+        for root, _, files in os.walk(self.path):
+            for f in files:
+                if f.endswith('.npy'):
+                    file_name = os.path.join(root, f)
+                    try:
+                        st = os.stat(file_name)
+                    except FileNotFoundError:
+                        continue
+                    yield st.st_mtime, st.st_size, file_name
+
+
+STIMULUS_CACHE = StimulusCache()
@@ -20,3 +20,38 @@ def to_native(key):
             if hasattr(v, 'dtype'):
                 key[k] = v.item()
     return key
+
+
+def populate_reserved(table, keys, make, suppress_errors=False):
+    """Populate table for a group of keys that are computed together.
+
+    Like populate(reserve_jobs=True), but make(keys) computes the tuples
+    for all keys at once. The keys are first reserved in the jobs table of
+    the schema; keys reserved by other workers are skipped. The tuples are
+    inserted in a single transaction, after which the jobs are released.
+    If make fails, all its keys are marked as errors in the jobs table.
+    """
+    jobs = table.connection.schemas[table.target.database].jobs
+    table_name = table.target.table_name
+    reserved = []
+    for key in keys:
+        if jobs.reserve(table_name, key):
+            if len(table & key):
+                jobs.complete(table_name, key)  # done in the meantime
+            else:
+                reserved.append(key)
+    if not reserved:
+        return
+    try:
+        tuples = make(reserved)
+        with table.connection.transaction:
+            table.insert(tuples)
+    except Exception as error:
+        for key in reserved:
+            jobs.error(table_name, key, error_message=str(error))
+        if not suppress_errors:
+            raise
+        print('Error for {:d} keys: {}'.format(len(reserved), error))
+    else:
+        for key in reserved:
+            jobs.complete(table_name, key)
@@ -0,0 +1,141 @@
+import os
+import numpy as np
+
+from .cache import writing, load_arrays
+
+
+def normalization(images, responses, chunk_size=1024):
+    """Normalization statistics of the training set, computed in chunks.
+
+    Same statistics as used by Dataset: mean and SD of all pixels and
+    per-neuron SD of the responses (with very small SDs set to one).
+    """
+    n = 0
+    sum_img, sum_img_sq = 0.0, 0.0
+    sum_res = np.zeros(responses.shape[1])
+    sum_res_sq = np.zeros(responses.shape[1])
+    for start in range(0, images.shape[0], chunk_size):
+        img = np.asarray(images[start:start+chunk_size], dtype=np.float64)
+        res = np.asarray(responses[start:start+chunk_size], dtype=np.float64)
+        n += res.shape[0]
+        sum_img += img.sum()
+        sum_img_sq += np.square(img).sum()
+        sum_res += res.sum(axis=0)
+        sum_res_sq += np.square(res).sum(axis=0)
+    num_px = images[0].size * n
+    image_mean = sum_img / num_px
+    image_sd = np.sqrt(sum_img_sq / num_px - image_mean ** 2)
+    response_sd = np.sqrt(np.maximum(sum_res_sq / n - (sum_res / n) ** 2, 0))
+    response_sd[response_sd < (response_sd.mean() / 100)] = 1
+    return dict(image_mean=np.array(image_mean),
+                image_sd=np.array(image_sd),
+                response_sd=response_sd)
+
+
+class LazyDataset:
+    """Dataset backed by memory-mapped arrays.
+
+    The raw images [samples x height x width] and responses of each split
+    are stored as .npy files and normalized on the fly, in the same way as
+    Dataset does it. Only the requested samples (a minibatch or a chunk)
+    are read into memory. Test responses are stored with all repeats
+    [repeats x images x neurons].
+
+    The interface is the same as for Dataset, plus chunks() for
+    iterating over a split.
+    """
+    _splits = ['train', 'val', 'test']
+
+    def __init__(self, path, chunk_size=1024):
+        arrays = load_arrays(path)
+        self.path = path
+        self.chunk_size = chunk_size
+        self.raw_images = {s: arrays['images_' + s] for s in self._splits}
+        self.raw_responses = {s: arrays['responses_' + s] for s in self._splits}
+        if 'image_mean' not in arrays:
+            arrays.update(normalization(
+                self.raw_images['train'], self.raw_responses['train'], chunk_size))
+        self.image_mean = float(arrays['image_mean'])
+        self.image_sd = float(arrays['image_sd'])
+        self.response_sd = np.array(arrays['response_sd'])
+
+        self.num_neurons = self.raw_responses['train'].shape[1]
+        self.num_train_samples = self.raw_images['train'].shape[0]
+        self.px_x = self.raw_images['train'].shape[2]
+        self.px_y = self.raw_images['train'].shape[1]
+        self.input_shape = [None, self.px_y, self.px_x, 1]
+        self.minibatch_idx = 1e10
+        self.train_perm = []
+
+    @staticmethod
+    def create(path,
+               images_train,
+               responses_train,
+               images_val,
+               responses_val,
+               images_test,
+               responses_test,
+               normalize=True,
+               chunk_size=1024):
+        """Write raw arrays to path and return the dataset.
+
+        Use normalize=False for arrays that are already normalized.
+        """
+        arrays = dict(images_train=images_train, responses_train=responses_train,
+                      images_val=images_val, responses_val=responses_val,
+                      images_test=images_test, responses_test=responses_test)
+        if normalize:
+            arrays.update(normalization(images_train, responses_train, chunk_size))
+        else:
+            arrays.update(image_mean=np.array(0.0),
+                          image_sd=np.array(1.0),
+                          response_sd=np.ones(responses_train.shape[1]))
+        with writing(path) as tmp:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, name + '.npy'), array)
+        return LazyDataset(path, chunk_size)
+
+    def images(self, split, idx=slice(None)):
+        images = np.asarray(self.raw_images[split][idx], dtype=np.float64)
+        return ((images - self.image_mean) / self.image_sd)[...,None]
+
+    def responses(self, split, idx=slice(None)):
+        responses = np.asarray(self.raw_responses[split][idx], dtype=np.float64)
+        return np.maximum(responses, 0) / self.response_sd
+
+    def val(self):
+        return self.images('val'), self.responses('val')
+
+    def train(self):
+        return self.images('train'), self.responses('train')
+
+    def test(self, averages=True):
+        images = self.images('test')
+        responses = self.responses('test')
+        return images, responses.mean(axis=0) if averages else responses
+
+    def chunks(self, split, chunk_size=None):
+        """Iterate over normalized (images, responses) of a split in chunks.
+
+        Test responses are averaged over repeats.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        for start in range(0, self.raw_images[split].shape[0], chunk_size):
+            idx = slice(start, start + chunk_size)
+            if split == 'test':
+                responses = self.responses(split, (slice(None), idx)).mean(axis=0)
+            else:
+                responses = self.responses(split, idx)
+            yield self.images(split, idx), responses
+
+    def minibatch(self, batch_size):
+        if self.minibatch_idx + batch_size > self.num_train_samples:
+            self.next_epoch()
+        idx = self.train_perm[self.minibatch_idx + np.arange(0, batch_size)]
+        self.minibatch_idx += batch_size
+        idx = np.sort(idx)  # sequential reads from disk
+        return self.images('train', idx), self.responses('train', idx)
+
+    def next_epoch(self):
+        self.minibatch_idx = 0
+        self.train_perm = np.random.permutation(self.num_train_samples)
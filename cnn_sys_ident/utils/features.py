@@ -0,0 +1,162 @@
+import os
+import numpy as np
+
+from .cache import writing, load_arrays
+
+
+def softplus(x):
+    # same as soft_threshold in the graph
+    return np.logaddexp(0, x)
+
+
+def numpy_readout(features, masks, feature_weights, biases):
+    """Readout computed in numpy (features: [batch, y, x, channels])."""
+    masked = np.einsum('nyxc,uyx->nuc', features, masks)
+    return softplus(np.einsum('nuc,uc->nu', masked, feature_weights) + biases)
+
+
+def readout_params(model, unit_ids=None):
+    """Masks, feature weights and biases of a CorePlusReadoutModel."""
+    readout = model.readout
+    masks, feature_weights, biases = model.base.evaluate(
+        [readout.masks, readout.feature_weights, readout.biases])
+    if unit_ids is not None:
+        masks, feature_weights, biases = masks[unit_ids], feature_weights[unit_ids], biases[unit_ids]
+    return masks, feature_weights, biases
+
+
+def _batches(images, batch_size):
+    for start in range(0, images.shape[0], batch_size):
+        yield images[start:start+batch_size]
+
+
+class FeatureStore:
+    """Core feature maps of a model for a fixed stimulus set, stored on disk.
+
+    The core output [images x height x width x channels] (and optionally
+    the outputs of all conv layers) is stored as memory-mapped .npy files.
+    Since the readout is linear in the core output up to the output
+    nonlinearity, predictions for any subset of units only need the cached
+    features (see readout()).
+    """
+    def __init__(self, path, chunk_size=1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.arrays = load_arrays(path)
+        self.output = self.arrays['output']
+        self.conv = [self.arrays['conv{:d}'.format(i)]
+                     for i in range(len(self.arrays) - 1)]
+        self.num_images = self.output.shape[0]
+
+    @staticmethod
+    def create(path, model, images, num_images=None, layers=False,
+               dtype=np.float32, batch_size=256):
+        """Run the core on images and write its outputs to path.
+
+        images is either an array (may be memory-mapped) or an iterable of
+        batches (e.g. GaborSet.image_batches), in which case num_images has
+        to be given. Outputs are written batch by batch, so the stimulus
+        set does not need to fit into memory. Use layers=True to store the
+        outputs of all conv layers in addition to the core output.
+        dtype=np.float16 halves the disk space, but changes the features
+        by up to 5e-4 (relative), so only use it for analysis, not for
+        training readouts.
+        """
+        if hasattr(images, 'shape'):
+            num_images = images.shape[0]
+            images = _batches(images, batch_size)
+        tensors = [model.core.output]
+        names = ['output']
+        if layers:
+            tensors += model.core.conv
+            names += ['conv{:d}'.format(i) for i in range(len(model.core.conv))]
+        with writing(path) as tmp:
+            arrays = [np.lib.format.open_memmap(
+                os.path.join(tmp, name + '.npy'), mode='w+', dtype=dtype,
+                shape=tuple([num_images] + t.shape.as_list()[1:]))
+                for t, name in zip(tensors, names)]
+            start = 0
+            for batch in images:
+                batch = np.asarray(batch)
+                if batch.ndim == 3:
+                    batch = batch[...,None]
+                feed_dict = {model.base.inputs: batch, model.base.is_training: False}
+                outputs = model.base.evaluate(tensors, feed_dict=feed_dict)
+                for array, output in zip(arrays, outputs):
+                    array[start:start+batch.shape[0]] = output
+                start += batch.shape[0]
+            assert start == num_images, 'Expected {:d} images, got {:d}'.format(num_images, start)
+            for array in arrays:
+                array.flush()
+            del arrays
+        return FeatureStore(path)
+
+    def chunks(self, layer='output', chunk_size=None):
+        """Iterate over the stored features of a layer in chunks (float32)."""
+        features = self.arrays[layer]
+        chunk_size = chunk_size or self.chunk_size
+        for start in range(0, self.num_images, chunk_size):
+            yield np.asarray(features[start:start+chunk_size], dtype=np.float32)
+
+    def readout(self, masks, feature_weights, biases, unit_ids=None):
+        """Predictions [images x units] from the cached core output.
+
+        masks, feature_weights and biases are the readout parameters of all
+        units (see readout_params); unit_ids selects a subset.
+        """
+        if unit_ids is not None:
+            masks, feature_weights, biases = masks[unit_ids], feature_weights[unit_ids], biases[unit_ids]
+        masks = masks.astype(np.float32)
+        feature_weights = feature_weights.astype(np.float32)
+        return np.concatenate([numpy_readout(f, masks, feature_weights, biases)
+                               for f in self.chunks()])
+
+
+class FeatureDataset:
+    """Dataset of cached core outputs instead of images.
+
+    Wraps a dataset and one FeatureStore per split (train, val, test) with
+    the core outputs for its images. It has the same interface as Dataset,
+    so a readout can be trained on the features with the regular Trainer.
+    """
+    def __init__(self, data, stores):
+        self.data = data
+        self.stores = stores
+        self.features_train = stores['train'].output
+        self.features_val = stores['val'].output
+        self.features_test = stores['test'].output
+        if hasattr(data, 'chunks'):
+            # LazyDataset: do not read the images
+            self.responses_train = data.responses('train')
+            self.responses_val = data.responses('val')
+        else:
+            _, self.responses_train = data.train()
+            _, self.responses_val = data.val()
+        self.num_neurons = data.num_neurons
+        self.num_train_samples = self.features_train.shape[0]
+        self.input_shape = [None] + list(self.features_train.shape[1:])
+        self.minibatch_idx = 1e10
+        self.train_perm = []
+
+    def val(self):
+        return self.features_val, self.responses_val
+
+    def train(self):
+        return self.features_train, self.responses_train
+
+    def test(self, averages=True):
+        _, responses = self.data.test(averages)
+        return self.features_test, responses
+
+    def minibatch(self, batch_size):
+        if self.minibatch_idx + batch_size > self.num_train_samples:
+            self.next_epoch()
+        idx = self.train_perm[self.minibatch_idx + np.arange(0, batch_size)]
+        self.minibatch_idx += batch_size
+        idx = np.sort(idx)  # sequential reads from disk
+        features = np.asarray(self.features_train[idx], dtype=np.float32)
+        return features, self.responses_train[idx]
+
+    def next_epoch(self):
+        self.minibatch_idx = 0
+        self.train_perm = np.random.permutation(self.num_train_samples)
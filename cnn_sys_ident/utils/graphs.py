@@ -0,0 +1,101 @@
+import os
+from collections import OrderedDict
+import tensorflow as tf
+
+from ..architectures.readouts import unit_readout
+from ..architectures.models import READOUT_COLLECTION
+
+
+# memory of restored inference graphs kept in the cache (see graph_bytes)
+GRAPH_CACHE_BYTES = int(os.environ.get('CNN_SYS_IDENT_GRAPH_CACHE_MB', 2**11)) * 2**20
+
+
+def import_network(graph, input_map, return_elements, name='net'):
+    """Import a model graph into the default graph.
+
+    Returns the requested outputs and a saver restoring the model's
+    variables from its checkpoint.
+    """
+    gdef = graph.as_graph_def()
+    with graph.as_default():
+        var_names = [v.name[:-2] for v in tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)]
+    outputs = tf.import_graph_def(
+        gdef, input_map=input_map, return_elements=return_elements, name=name)
+    g = tf.get_default_graph()
+    var_list = {v: g.get_tensor_by_name('{}/{}:0'.format(name, v)) for v in var_names}
+    return outputs, tf.train.Saver(var_list=var_list)
+
+
+def import_unit_predictions(graph, inputs, unit_ids, paired=False, name='net', scope=None):
+    """Import a model, evaluating the readout only for the given units.
+
+    See readouts.unit_readout for unit_ids and paired. The readout tensors
+    are looked up in the collection recorded when the model was built
+    (models.READOUT_COLLECTION). If the graph contains several models (e.g.
+    replicas of PackedTrainer), scope selects one of them. Returns the
+    predictions and a saver restoring the model's variables.
+    """
+    tensors = graph.get_collection(READOUT_COLLECTION, scope)
+    if len(tensors) != 4:
+        raise ValueError(
+            'Expected the readout tensors of one model in collection {} (scope: {}), '
+            'found {:d} tensors. Build the model as CorePlusReadoutModel and pass '
+            'scope if the graph contains several models.'.format(
+                READOUT_COLLECTION, scope, len(tensors)))
+    (core, masks, feature_weights, biases), saver = import_network(
+        graph, {'inputs:0': inputs, 'is_training:0': tf.constant(False)},
+        [t.name for t in tensors], name)
+    return unit_readout(core, masks, feature_weights, biases, unit_ids, paired), saver
+
+
+def graph_bytes(graph):
+    """Memory held by a graph and its session between runs (approximately).
+
+    The serialized graph (including constants such as stimuli or rotation
+    matrices) plus the values of its variables. Activations are freed after
+    each session.run, so they are not counted.
+    """
+    with graph.as_default():
+        variables = tf.global_variables()
+    return graph.as_graph_def().ByteSize() + sum(
+        v.shape.num_elements() * v.dtype.base_dtype.size for v in variables)
+
+
+class GraphCache:
+    """LRU cache of restored inference graphs.
+
+    Entries are keyed by checkpoint file (and its modification time, so
+    refitted models are not reused) plus a key describing how the network
+    was imported. Each entry (a worker with attribute graph) takes
+    graph_bytes(worker.graph); the least recently used entries are dropped
+    until the total is at most max_bytes. The newest entry is always kept.
+    """
+    def __init__(self, max_bytes=GRAPH_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = dict()
+
+    def get(self, checkpoint_file, key, build):
+        key = (checkpoint_file, _mtime(checkpoint_file), key)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        worker = build()
+        self.entries[key] = worker
+        self.sizes[key] = graph_bytes(worker.graph)
+        while len(self.entries) > 1 and sum(self.sizes.values()) > self.max_bytes:
+            oldest, _ = self.entries.popitem(last=False)
+            del self.sizes[oldest]
+        return worker
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+
+
+def _mtime(checkpoint_file):
+    index_file = checkpoint_file + '.index'
+    return os.path.getmtime(index_file) if os.path.exists(index_file) else None
+
+
+GRAPH_CACHE = GraphCache()
@@ -0,0 +1,145 @@
+import numpy as np
+import tensorflow as tf
+
+from .graphs import import_network
+from ..architectures.utils import soft_threshold
+from ..architectures.readouts import unit_readout
+
+
+def receptive_field(tensor):
+    """Receptive field radius of tensor and whether it uses SAME padding.
+
+    Sums the radii of all 2d convolutions tensor depends on (assumes
+    stride 1, as in all cores).
+    """
+    radius, same_padding = 0, False
+    ops, seen = [tensor.op], set()
+    while ops:
+        op = ops.pop()
+        if op.name in seen:
+            continue
+        seen.add(op.name)
+        if op.type in ['Conv2D', 'DepthwiseConv2dNative']:
+            filter_size = op.inputs[1].shape.as_list()[0]
+            radius += (filter_size - 1) // 2
+            same_padding |= op.get_attr('padding') in [b'SAME', 'SAME']
+        ops.extend(t.op for t in op.inputs)
+    return radius, same_padding
+
+
+class TranslationSweep:
+    """Responses to a stimulus at all locations of a grid in one pass.
+
+    The cores are translation equivariant (stride 1), so instead of running
+    the core once per location, it is run once on a larger canvas containing
+    the stimulus at the last location of the grid (see
+    GaborSet.location_sweep). The core output, weighted by each unit's
+    feature weights, is then correlated with the unit's readout mask; shifts
+    of the mask correspond to stimulus locations.
+
+    Border effects: with VALID padding this is exact. With SAME padding, core
+    outputs within the receptive field radius of the image border differ if
+    the stimulus reaches the border, because the network sees zero padding
+    there while the large canvas continues the stimulus. Responses of units
+    with mask weight in this region (see border_units) are then wrong for
+    such stimuli and have to be evaluated with the full network.
+    """
+    def __init__(self, graph, checkpoint_file, model, canvas_size, num_locations):
+        width, height = canvas_size
+        num_x, num_y = num_locations
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.inputs = tf.placeholder(
+                tf.float32, shape=[None, height+num_y-1, width+num_x-1, 1], name='inputs')
+            readout = model.readout
+            (core, masks, feature_weights, biases), saver = import_network(
+                graph, {'inputs:0': self.inputs, 'is_training:0': tf.constant(False)},
+                [model.core.output.name, readout.masks.name,
+                 readout.feature_weights.name, readout.biases.name])
+            num_units = masks.shape.as_list()[0]
+            self.radius, self.same_padding = receptive_field(core)
+            mask_values = masks
+
+            # core output weighted by feature weights: [batch, y, x, units]
+            weighted = tf.tensordot(core, feature_weights, [[3], [1]])
+
+            # correlate with masks; output (i, j) is location (x_end-1-j, y_end-1-i)
+            masks = tf.expand_dims(tf.transpose(masks, [1, 2, 0]), 3)
+            h = tf.nn.depthwise_conv2d(weighted, masks, strides=[1, 1, 1, 1], padding='VALID')
+            h = tf.transpose(tf.reverse(h, axis=[1, 2]), [0, 2, 1, 3])
+
+            # [batch, locations, units] with locations ordered as in GaborSet
+            h = tf.reshape(h, [-1, num_x * num_y, num_units])
+            self.responses = soft_threshold(h + biases)
+            self.session = tf.Session()
+            saver.restore(self.session, checkpoint_file)
+            self.masks = self.session.run(mask_values)
+
+    def __del__(self):
+        try:
+            if not self.session == None:
+                self.session.close()
+        except:
+            pass
+
+    def evaluate(self, images):
+        return self.session.run(self.responses, feed_dict={self.inputs: images})
+
+    def border_units(self, tol=0.01):
+        """Units whose mask has weight near the image border.
+
+        Returns [units, 4] for the left, right, top and bottom border: whether
+        the mask weight within the receptive field radius of that border
+        exceeds tol times the unit's total mask weight. All False with VALID
+        padding, where the sweep is exact.
+        """
+        r = self.radius
+        if not (self.same_padding and r):
+            return np.zeros([self.masks.shape[0], 4], dtype=bool)
+        m = np.abs(self.masks)
+        border = [m[:,:,:r], m[:,:,-r:], m[:,:r], m[:,-r:]]
+        total = m.sum(axis=(1, 2))
+        return np.stack([b.sum(axis=(1, 2)) > tol * total for b in border], axis=1)
+
+
+class PlaidTuning:
+    """Responses of units to plaids composed inside the graph.
+
+    For each unit, two stacks of components [num_components, H, W] are fed
+    (preferred and orthogonal) and all pairwise sums are formed by
+    broadcasting. Only the readout of the unit belonging to each plaid is
+    evaluated. Returns responses [num_units, orthogonal, preferred].
+    """
+    def __init__(self, graph, checkpoint_file, model, canvas_size, num_units, num_components):
+        width, height = canvas_size
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            shape = [num_units, num_components, height, width]
+            self.preferred = tf.placeholder(tf.float32, shape=shape, name='preferred')
+            self.orthogonal = tf.placeholder(tf.float32, shape=shape, name='orthogonal')
+            plaids = self.orthogonal[:,:,None] + self.preferred[:,None]
+            plaids = tf.reshape(plaids, [-1, height, width, 1])
+            readout = model.readout
+            (core, masks, feature_weights, biases), saver = import_network(
+                graph, {'inputs:0': plaids, 'is_training:0': tf.constant(False)},
+                [model.core.output.name, readout.masks.name,
+                 readout.feature_weights.name, readout.biases.name])
+
+            # readout of each unit for its own plaids only
+            self.units = tf.placeholder(tf.int32, shape=[num_units], name='units')
+            plaid_units = tf.reshape(tf.tile(self.units[:,None], [1, num_components ** 2]), [-1])
+            responses = unit_readout(core, masks, feature_weights, biases, plaid_units, paired=True)
+            self.responses = tf.reshape(responses, [num_units, num_components, num_components])
+            self.session = tf.Session()
+            saver.restore(self.session, checkpoint_file)
+
+    def __del__(self):
+        try:
+            if not self.session == None:
+                self.session.close()
+        except:
+            pass
+
+    def evaluate(self, unit_ids, preferred, orthogonal):
+        feed_dict = {self.units: unit_ids, self.preferred: preferred, self.orthogonal: orthogonal}
+        return self.session.run(self.responses, feed_dict=feed_dict)
@@ -1,6 +1,8 @@
 import tensorflow as tf
 import numpy as np
 
+from .graphs import import_unit_predictions, GRAPH_CACHE
+
 
 @tf.RegisterGradient('gradient_preconditioning')
 def _gradient_preconditioning(op, grad):
@@ -19,15 +21,23 @@ def _gradient_preconditioning(op, grad):
 
 
 class ActivityMaximization:
-    def __init__(self, graph, checkpoint_file, input_shape, cell_id, smoothness, norm, num_images=1):
-        gdef = graph.as_graph_def()
-        with graph.as_default():
-            var_names = [v.name[:-2] for v in tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)]
+    """Optimize images maximizing the activity of one or several units.
+
+    cell_id can be a single unit or a list of units. In the latter case each
+    unit gets its own num_images image slots and its own early stopping, but
+    all units share a single imported graph and session. num_units is the
+    number of unit slots of the graph (default: number of units in cell_id);
+    fewer units can be optimized by padding (see set_units).
+    """
+    def __init__(self, graph, checkpoint_file, input_shape, cell_id, smoothness, norm,
+                 num_images=1, num_units=None):
+        self.num_units = num_units = num_units or len(np.atleast_1d(cell_id))
+        self.num_images = num_images
         self.graph = tf.Graph()
         with self.graph.as_default():
             images_raw = tf.get_variable(
                 'inputs',
-                shape=[num_images, input_shape[0], input_shape[1], 1],
+                shape=[num_units * num_images, input_shape[0], input_shape[1], 1],
                 initializer=tf.random_normal_initializer())
             image_norm = tf.sqrt(tf.reduce_sum(tf.square(images_raw), axis=[1, 2], keep_dims=True))
             self.images = norm * images_raw / image_norm
@@ -36,25 +46,71 @@ class ActivityMaximization:
             with self.graph.gradient_override_map({'Identity': 'gradient_preconditioning'}):
                 self.images = tf.identity(self.images, name='Identity')
 
-            # smoothness prior
+            # smoothness prior (per unit)
             lap = tf.constant([[0.25, 0.5, 0.25],
                                [0.5, -3.0, 0.5 ],
                                [0.25, 0.5, 0.25]], shape=[3, 3, 1, 1])
             images_lap = tf.nn.conv2d(self.images, lap, strides=[1, 1, 1, 1], padding='SAME')
-            self.smooth_reg = smoothness * tf.reduce_sum(tf.square(images_lap))
-
-            self.predictions, = tf.import_graph_def(
-                gdef, input_map={'inputs:0': self.images, 'is_training:0': tf.constant(False)},
-                name='net', return_elements=['readout/output:0'])
-            self.predictions = self.predictions[:,cell_id]
-            self.loss = -tf.reduce_sum(self.predictions) + self.smooth_reg
-            var_list = {name: self.graph.get_tensor_by_name('net/{}:0'.format(name)) for name in var_names}
-            saver = tf.train.Saver(var_list=var_list)
+            smooth_reg = smoothness * tf.reduce_sum(
+                tf.reshape(tf.square(images_lap), [num_units, -1]), axis=1)
+            self.smooth_reg = tf.reduce_sum(smooth_reg)
+
+            # image slots are ordered by unit: [unit0 x num_images, unit1 x num_images, ...]
+            self.units = tf.placeholder(tf.int32, shape=[num_units], name='units')
+            slot_units = tf.reshape(tf.tile(self.units[:,None], [1, num_images]), [-1])
+            predictions, saver = import_unit_predictions(
+                graph, self.images, slot_units, paired=True)
+            self.predictions = tf.reshape(predictions, [num_units, num_images])
+
+            # units that converged are masked out of the loss
+            self.active = tf.placeholder_with_default(
+                tf.ones([num_units]), shape=[num_units], name='active')
+            self.unit_loss = -tf.reduce_sum(self.predictions, axis=1) + smooth_reg
+            self.loss = tf.reduce_sum(self.active * self.unit_loss)
             self.lr = tf.placeholder(tf.float32, shape=[], name='learning_rate')
             self.train_step = tf.train.AdamOptimizer(self.lr).minimize(self.loss, var_list=[images_raw])
+
+            # only covers images and optimizer state, the network is restored
+            self.initializer = tf.global_variables_initializer()
             self.session = tf.Session()
             saver.restore(self.session, checkpoint_file)
-            self.session.run(tf.global_variables_initializer())
+        self.set_units(cell_id)
+
+    @classmethod
+    def cached(cls, get_graph, checkpoint_file, cell_id, smoothness, norm, num_images=1,
+               num_units=None):
+        """Worker from the graph cache, set up for the given units.
+
+        get_graph() is only called if no worker is cached for this model and
+        returns the model's graph and the input shape. Pass a fixed num_units
+        (e.g. the batch size) to reuse the worker for smaller batches.
+        """
+        num_units = num_units or len(np.atleast_1d(cell_id))
+        key = (cls.__name__, num_units, smoothness, norm, num_images)
+        built = []
+        def build():
+            graph, input_shape = get_graph()
+            built.append(True)
+            return cls(graph, checkpoint_file, input_shape, cell_id, smoothness, norm,
+                       num_images, num_units)
+        worker = GRAPH_CACHE.get(checkpoint_file, key, build)
+        if not built:
+            worker.set_units(cell_id)
+        return worker
+
+    def set_units(self, cell_id):
+        """Select the units to optimize and reset images and optimizer.
+
+        If there are fewer units than slots, the remaining slots are filled
+        with the last unit and not optimized.
+        """
+        self.single_unit = np.isscalar(cell_id)
+        unit_ids = np.atleast_1d(cell_id)
+        assert len(unit_ids) <= self.num_units, 'Too many units'
+        self.num_requested = len(unit_ids)
+        self.unit_ids = np.concatenate(
+            [unit_ids, np.repeat(unit_ids[-1:], self.num_units - len(unit_ids))])
+        self.session.run(self.initializer)
 
     def __del__(self):
         try:
@@ -64,48 +120,90 @@ class ActivityMaximization:
             pass
 
     def maximize(self, learning_rate=1.0, max_iter=1000, patience=100, callback=None, callback_every=100):
+        """Run the optimization.
+
+        Returns images [units, num_images, H, W, 1], predictions
+        [units, num_images] and the loss history [iterations, units], which is
+        NaN for units that already stopped. For a single unit the unit axis is
+        dropped.
+        """
+        num_units = self.num_units
+        images = np.zeros([num_units, self.num_images] + self.images.shape.as_list()[1:],
+                          dtype=np.float32)
+        predictions = np.zeros([num_units, self.num_images], dtype=np.float32)
+        active = np.arange(num_units) < self.num_requested  # padding is not optimized
         loss = []
-        min_loss = 1e10
-        not_decreased = 0
+        min_loss = np.full(num_units, 1e10)
+        not_decreased = np.zeros(num_units, dtype=int)
         alpha = 0.9
         for i in range(max_iter):
-            feed_dict = {self.lr: learning_rate}
-            _, loss_i = self.session.run([self.train_step, self.loss], feed_dict=feed_dict)
+            feed_dict = {self.lr: learning_rate,
+                         self.active: active.astype(np.float32),
+                         self.units: self.unit_ids}
+            _, loss_i = self.session.run([self.train_step, self.unit_loss], feed_dict=feed_dict)
+            loss_i[~active] = np.nan
             loss.append(loss_i)
             loss_ema = alpha * loss_ema + (1 - alpha) * loss_i if i > 0 else loss_i
-            if loss_ema < min_loss:
-                min_loss = loss_ema
-                not_decreased = 0
-            else:
-                not_decreased += 1
-            if not_decreased > patience:
+            decreased = loss_ema < min_loss
+            min_loss[decreased] = loss_ema[decreased]
+            not_decreased[decreased] = 0
+            not_decreased[~decreased] += 1
+            converged = active & (not_decreased > patience)
+            if converged.any():
+                self._store(images, predictions, converged)
+                active &= ~converged
+            if not active.any():
                 break
             if callback is not None and not ((i+1) % callback_every):
                 callback(self, i)
 
-        images, predictions = self.session.run([self.images, self.predictions])
-        return images, predictions, np.array(loss)
+        if active.any():
+            self._store(images, predictions, active)
+        n = self.num_requested
+        images, predictions, loss = images[:n], predictions[:n], np.array(loss)[:,:n]
+        if self.single_unit:
+            return images[0], predictions[0], loss[:,0]
+        return images, predictions, loss
+
+    def _store(self, images, predictions, units):
+        images_i, predictions_i = self.session.run(
+            [self.images, self.predictions], feed_dict={self.units: self.unit_ids})
+        images_i = images_i.reshape(images.shape)
+        images[units] = images_i[units]
+        predictions[units] = predictions_i[units]
 
 
 class GradientRF:
+    """Gradient of unit responses with respect to a blank image.
+
+    The image is replicated once per requested unit and each copy
+    backpropagates only its own unit, so the gradients of a whole block of
+    units are computed in a single run of one precompiled op.
+    """
     def __init__(self, graph, checkpoint_file, input_shape):
-        gdef = graph.as_graph_def()
-        with graph.as_default():
-            var_names = [v.name[:-2] for v in tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)]
         self.graph = tf.Graph()
         with self.graph.as_default():
             self.image = tf.get_variable('inputs', shape=input_shape,
                         initializer=tf.constant_initializer(0.0))
-            self._image = tf.reshape(self.image, [1, input_shape[0], input_shape[1], 1])
-            self.predictions, = tf.import_graph_def(
-                        gdef, input_map={'inputs:0': self._image, 'is_training:0': tf.constant(False)},
-                        name='net', return_elements=['readout/output:0'])
-            var_list = {name: self.graph.get_tensor_by_name('net/{}:0'.format(name)) for name in var_names}
-            self.saver = tf.train.Saver(var_list=var_list)
+            self.units = tf.placeholder(tf.int32, shape=[None], name='units')
+            num_units = tf.shape(self.units)[0]
+            self._image = tf.tile(tf.reshape(self.image, [1, input_shape[0], input_shape[1], 1]),
+                                  [num_units, 1, 1, 1])
+            self.predictions, self.saver = import_unit_predictions(
+                graph, self._image, self.units, paired=True)
+            self.grad = tf.gradients(self.predictions, self._image)[0][...,0]
             self.session = tf.Session()
             self.saver.restore(self.session, checkpoint_file)
             self.session.run(tf.global_variables_initializer())
 
+    @classmethod
+    def cached(cls, get_graph, checkpoint_file):
+        """Worker from the graph cache (see ActivityMaximization.cached)."""
+        def build():
+            graph, input_shape = get_graph()
+            return cls(graph, checkpoint_file, input_shape)
+        return GRAPH_CACHE.get(checkpoint_file, (cls.__name__, ), build)
+
     def __del__(self):
         try:
             if not self.session == None:
@@ -113,6 +211,140 @@ class GradientRF:
         except:
             pass
 
+    def gradients(self, unit_ids, block_size=64):
+        """Gradients for a list of units, [num_units, H, W].
+
+        block_size bounds the number of image copies (and activations) held
+        in memory at once.
+        """
+        unit_ids = np.asarray(unit_ids)
+        grads = [self.session.run(self.grad, feed_dict={self.units: unit_ids[i:i+block_size]})
+                 for i in range(0, len(unit_ids), block_size)]
+        return np.concatenate(grads, axis=0)
+
     def gradient(self, cell_id):
-        grad = tf.gradients(self.predictions[0,cell_id], self.image)[0]
-        return self.session.run(grad)
+        return self.gradients([cell_id])[0]
+
+
+def gabor_images(canvas_size, x, y, size, spatial_frequency, contrast, orientation, phase):
+    """Gabors as in GaborSet.gabor, differentiable w.r.t. the parameters.
+
+    Parameters are tensors [num_images], returns [num_images, H, W, 1].
+    """
+    width, height = canvas_size
+    expand = lambda p: p[:,None,None]
+    u = tf.range(width, dtype=tf.float32)[None,None,:] - expand(x)
+    v = tf.range(height, dtype=tf.float32)[None,:,None] - expand(y)
+    cos, sin = expand(tf.cos(orientation)), expand(tf.sin(orientation))
+    u, v = cos * u - sin * v, sin * u + cos * v
+    envelope = 0.5 * expand(contrast) * tf.exp(-(u ** 2 + v ** 2) / (2 * expand(size/4)**2))
+    grating = tf.cos(expand(spatial_frequency) * u * (2*np.pi) + expand(phase))
+    return tf.expand_dims(envelope * grating, 3)
+
+
+class GaborFit:
+    """Gabor parameters maximizing the activity of units by gradient ascent.
+
+    Gabors are rendered inside the graph (see gabor_images). Each unit gets
+    num_starts independently optimized parameter sets. Location, size,
+    spatial frequency and contrast are kept within bounds (a dict as
+    returned by GaborSet.bounds) via sigmoids, on a log scale for positive
+    ranges. Orientation and phase are unconstrained.
+    """
+    _bounded = ['x', 'y', 'size', 'spatial_frequency', 'contrast']
+
+    def __init__(self, graph, checkpoint_file, canvas_size, bounds, num_units,
+                 num_starts=1, relative_sf=True):
+        self.num_units = num_units
+        self.num_starts = num_starts
+        num_slots = num_units * num_starts
+        lo, hi = np.array([bounds[p] for p in self._bounded], dtype=np.float64).T
+        self.log_scale = np.array([p not in ['x', 'y'] for p in self._bounded]) & (lo > 0)
+        self.lo = np.where(self.log_scale, np.log(np.maximum(lo, 1e-10)), lo)
+        self.hi = np.where(self.log_scale, np.log(np.maximum(hi, 1e-10)), hi)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.z = tf.get_variable('params', shape=[num_slots, 7],
+                                     initializer=tf.zeros_initializer())
+            self.z_init = tf.placeholder(tf.float32, shape=[num_slots, 7], name='init')
+            self.assign = tf.assign(self.z, self.z_init)
+
+            # map to parameter ranges
+            lo, hi = tf.constant(self.lo, tf.float32), tf.constant(self.hi, tf.float32)
+            p = lo + tf.sigmoid(self.z[:,:5]) * (hi - lo)
+            p = tf.where(np.tile(self.log_scale, [num_slots, 1]), tf.exp(p), p)
+            x, y, size, spatial_frequency, contrast = tf.unstack(p, axis=1)
+            if relative_sf:
+                spatial_frequency /= size
+            orientation, phase = self.z[:,5], self.z[:,6]
+            self.params = tf.reshape(
+                tf.stack([x, y, size, spatial_frequency, contrast, orientation, phase], axis=1),
+                [num_units, num_starts, 7])
+            self.relative_sf = relative_sf
+
+            images = gabor_images(canvas_size, x, y, size, spatial_frequency,
+                                  contrast, orientation, phase)
+            self.units = tf.placeholder(tf.int32, shape=[num_units], name='units')
+            slot_units = tf.reshape(tf.tile(self.units[:,None], [1, num_starts]), [-1])
+            predictions, saver = import_unit_predictions(graph, images, slot_units, paired=True)
+            self.predictions = tf.reshape(predictions, [num_units, num_starts])
+            self.loss = -tf.reduce_sum(self.predictions)
+            self.lr = tf.placeholder(tf.float32, shape=[], name='learning_rate')
+            self.train_step = tf.train.AdamOptimizer(self.lr).minimize(self.loss, var_list=[self.z])
+            self.initializer = tf.global_variables_initializer()
+            self.session = tf.Session()
+            saver.restore(self.session, checkpoint_file)
+
+    @classmethod
+    def cached(cls, get_graph, checkpoint_file, canvas_size, bounds, num_units,
+               num_starts=1, relative_sf=True):
+        """Worker from the graph cache (see ActivityMaximization.cached)."""
+        key = (cls.__name__, tuple(canvas_size), tuple(sorted(bounds.items())),
+               num_units, num_starts, relative_sf)
+        def build():
+            graph = get_graph()
+            return cls(graph, checkpoint_file, canvas_size, bounds, num_units,
+                       num_starts, relative_sf)
+        return GRAPH_CACHE.get(checkpoint_file, key, build)
+
+    def __del__(self):
+        try:
+            if not self.session == None:
+                self.session.close()
+        except:
+            pass
+
+    def fit(self, unit_ids, init, learning_rate=0.05, num_steps=300):
+        """Optimize Gabor parameters for the given units.
+
+        init are starting parameters [num_units, num_starts, 7] ordered as
+        x, y, size, spatial frequency (absolute), contrast, orientation,
+        phase, e.g. from the best stimuli of a coarse grid.
+
+        Returns the parameters of the best start of each unit [num_units, 7]
+        and its response [num_units].
+        """
+        self.session.run(self.initializer)
+        self.session.run(self.assign, feed_dict={self.z_init: self._unconstrained(init)})
+        feed_dict = {self.units: unit_ids, self.lr: learning_rate}
+        for i in range(num_steps):
+            self.session.run(self.train_step, feed_dict=feed_dict)
+        params, predictions = self.session.run([self.params, self.predictions], feed_dict=feed_dict)
+        best = predictions.argmax(axis=1)
+        units = np.arange(self.num_units)
+        params = params[units, best]
+
+        # canonical orientation in [0, pi): rotating by pi negates the phase
+        flip = np.floor(params[:,5] / np.pi) % 2 == 1
+        params[:,5] %= np.pi
+        params[:,6] = np.where(flip, -params[:,6], params[:,6]) % (2*np.pi)
+        return params, predictions[units, best]
+
+    def _unconstrained(self, params):
+        params = np.array(params, dtype=np.float64).reshape([-1, 7])
+        if self.relative_sf:
+            params[:,3] *= params[:,2]
+        p = params[:,:5]
+        p = np.where(self.log_scale, np.log(np.maximum(p, 1e-10)), p)
+        s = np.clip((p - self.lo) / np.maximum(self.hi - self.lo, 1e-10), 1e-3, 1 - 1e-3)
+        return np.concatenate([np.log(s / (1 - s)), params[:,5:]], axis=1)
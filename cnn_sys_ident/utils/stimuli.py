@@ -1,5 +1,10 @@
 import numpy as np
 from numpy import pi
+from collections import deque
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import array_key
 
 
 class GaborSet:
@@ -13,6 +18,7 @@ class GaborSet:
                  phases,
                  relative_sf=True):   # scale SF by size (True) or use absolute units (False)
         self.canvas_size = canvas_size
+        self.center_range = center_range
         cr = center_range
         self.locations = np.array(
             [[x, y] for x in range(cr[0], cr[1]) 
@@ -37,19 +43,71 @@ class GaborSet:
             len(self.phases),
         ]
         self.relative_sf = relative_sf
+        self._grid = None
 
     def params_from_idx(self, idx):
+        # works for single indices and arrays of indices
         c = np.unravel_index(idx, self.num_params)
         location = self.locations[c[0]]
-        size = self.sizes[c[1]]
-        spatial_frequency = self.spatial_frequencies[c[2]]
+        size = np.asarray(self.sizes)[c[1]]
+        spatial_frequency = np.asarray(self.spatial_frequencies)[c[2]]
         if self.relative_sf:
-            spatial_frequency /= size
-        contrast = self.contrasts[c[3]]
-        orientation = self.orientations[c[4]]
-        phase = self.phases[c[5]]
+            spatial_frequency = spatial_frequency / size
+        contrast = np.asarray(self.contrasts)[c[3]]
+        orientation = np.asarray(self.orientations)[c[4]]
+        phase = np.asarray(self.phases)[c[5]]
         return location, size, spatial_frequency, contrast, orientation, phase
         
+    def location_sweep(self):
+        """Stimuli without the location axis on a canvas covering all locations.
+
+        The stimulus at location (x, y) equals the crop
+        [y_end-1-y : y_end-1-y+H, x_end-1-x : x_end-1-x+W] of the
+        corresponding stimulus of the returned set. Index i of the returned
+        set corresponds to indices loc * len(sweep) + i of this set, where
+        len(sweep) is the number of its stimuli.
+        """
+        width, height = self.canvas_size
+        x_start, x_end, y_start, y_end = self.center_range
+        canvas_size = [width + x_end - x_start - 1, height + y_end - y_start - 1]
+        return GaborSet(canvas_size, [x_end-1, x_end, y_end-1, y_end],
+                        self.sizes, self.spatial_frequencies, self.contrasts,
+                        list(self.orientations), list(self.phases), self.relative_sf)
+
+    def border_sides(self, extent=1.0):
+        """Canvas borders reached by the stimuli of each location and size.
+
+        Returns [locations, sizes, 4] for the left, right, top and bottom
+        border. A stimulus reaches a border if its center is closer to it
+        than extent times its size (i.e. 4 SD of the envelope, where it has
+        decayed to exp(-8), for extent=1).
+        """
+        width, height = self.canvas_size
+        x, y = self.locations[:,0,None], self.locations[:,1,None]
+        d = extent * np.asarray(self.sizes)[None]
+        return np.stack([x - d < 0, x + d > width - 1, y - d < 0, y + d > height - 1], axis=2)
+
+    def cache_key(self):
+        """Content hash of the stimulus set (see cache.array_key)."""
+        return array_key('GaborSet', self.canvas_size, self.center_range, self.sizes,
+                         self.spatial_frequencies, self.contrasts, self.orientations,
+                         self.phases, self.relative_sf)
+
+    def bounds(self):
+        """Range of the continuous parameters covered by the set.
+
+        Spatial frequencies are relative to size if relative_sf is set.
+        """
+        x_start, x_end, y_start, y_end = self.center_range
+        return {
+            'x': (x_start, x_end - 1),
+            'y': (y_start, y_end - 1),
+            'size': (np.min(self.sizes), np.max(self.sizes)),
+            'spatial_frequency': (np.min(self.spatial_frequencies),
+                                  np.max(self.spatial_frequencies)),
+            'contrast': (np.min(self.contrasts), np.max(self.contrasts)),
+        }
+
     def params_dict_from_idx(self, idx):
         (location, size, spatial_frequency, 
             contrast, orientation, phase) = self.params_from_idx(idx)
@@ -66,25 +124,276 @@ class GaborSet:
         return self.gabor(*self.params_from_idx(idx))
 
     def gabor(self, location, size, spatial_frequency, contrast, orientation, phase):
-        x, y = np.meshgrid(np.arange(self.canvas_size[0]) - location[0],
-                           np.arange(self.canvas_size[1]) - location[1])
-        R = np.array([[np.cos(orientation), -np.sin(orientation)],
-                      [np.sin(orientation),  np.cos(orientation)]])
-        coords = np.stack([x.flatten(), y.flatten()])
-        x, y = R.dot(coords).reshape((2, ) + x.shape)
+        x, y = self._coords(location, orientation)
         envelope = 0.5 * contrast * np.exp(-(x ** 2 + y ** 2) / (2 * (size/4)**2))
         
         grating = np.cos(spatial_frequency * x * (2*pi) + phase)
         return envelope * grating
 
-    def image_batches(self, batch_size):
+    def _coords(self, location, orientation):
+        if self._grid is None:
+            self._grid = np.meshgrid(np.arange(self.canvas_size[0]),
+                                     np.arange(self.canvas_size[1]))
+        x, y = self._grid[0] - location[0], self._grid[1] - location[1]
+        R = np.array([[np.cos(orientation), -np.sin(orientation)],
+                      [np.sin(orientation),  np.cos(orientation)]])
+        coords = np.stack([x.flatten(), y.flatten()])
+        return R.dot(coords).reshape((2, ) + x.shape)
+
+    def gabors(self, idx, out=None):
+        """Render the Gabors with the given indices, [len(idx), H, W]."""
+        return self.render(*self.params_from_idx(np.asarray(idx)), out=out)
+
+    def render(self, location, size, spatial_frequency, contrast, orientation, phase, out=None):
+        """Render Gabors from parameter arrays (location: [n, 2], others: [n]).
+
+        Gives the same output as gabor, but rotated coordinates, envelopes
+        and gratings are computed only once for all stimuli of the batch
+        that share them.
+        """
+        location = np.asarray(location)
+
+        # rotated coordinates for each (location, orientation)
+        first, coords_idx = _unique_rows(location[:,0], location[:,1], orientation)
+        coords = np.array([self._coords(location[i], orientation[i]) for i in first])
+        x = coords[:,0]
+        r2 = x ** 2 + coords[:,1] ** 2
+
+        # envelope for each (location, orientation, size, contrast)
+        first, envelope_idx = _unique_rows(coords_idx, size, contrast)
+        envelope = (0.5 * contrast[first])[:,None,None] * \
+            np.exp(-r2[coords_idx[first]] / (2 * (size[first]/4)**2)[:,None,None])
+
+        # grating for each (location, orientation, spatial frequency, phase)
+        first, grating_idx = _unique_rows(coords_idx, spatial_frequency, phase)
+        grating = np.cos(spatial_frequency[first][:,None,None] * x[coords_idx[first]] * (2*pi) \
+                         + phase[first][:,None,None])
+
+        return np.multiply(envelope[envelope_idx], grating[grating_idx], out=out)
+
+    def image_batches(self, batch_size, num_workers=0, num_buffers=None, dtype=np.float64,
+                      cache=None):
+        """Iterate over all stimuli in batches.
+
+        With num_workers > 0 the next batches are rendered by a thread pool
+        while the caller processes the current one. Batches are then
+        rendered into num_buffers reusable buffers (default: num_workers + 2),
+        so a yielded batch is only valid until the next one is requested.
+
+        If a StimulusCache is given, batches are read from it (memory-mapped)
+        and rendered only if missing. Each batch is a separate entry, so a
+        partially cached set still saves work. If the set is larger than
+        the cache, only its first batches are cached (scanning all of them
+        would evict each batch before it is read again).
+        """
         num_stims = np.prod(self.num_params)
-        for batch_start in np.arange(0, num_stims, batch_size):
+        starts = np.arange(0, num_stims, batch_size)
+        num_cached = len(starts)
+        if cache is not None:
+            set_key = self.cache_key()
+            batch_bytes = batch_size * np.prod(self.canvas_size) * np.dtype(dtype).itemsize
+            num_cached = min(num_cached, int(0.9 * cache.max_bytes // batch_bytes))
+            if num_cached < len(starts):
+                print('Stimulus set too large for cache: caching {:d} of {:d} batches'.format(
+                    num_cached, len(starts)))
+
+        def render(i, out=None):
+            batch_start = starts[i]
             batch_end = np.minimum(batch_start + batch_size, num_stims)
-            images = [self.gabor_from_idx(i)
-                          for i in range(batch_start, batch_end)]
-            yield np.array(images)
+            if out is not None:
+                out = out[:batch_end-batch_start]
+            images = lambda: self.gabors(np.arange(batch_start, batch_end), out=out) \
+                .astype(dtype, copy=False)
+            if cache is None or i >= num_cached:
+                return images()
+            key = array_key(set_key, batch_start, batch_end, np.dtype(dtype).str)
+            return cache.get(key, images)
+
+        if not num_workers:
+            for i in range(len(starts)):
+                yield render(i)
+            return
+
+        num_buffers = num_buffers or num_workers + 2
+        shape = [batch_size, self.canvas_size[1], self.canvas_size[0]]
+        buffers = [np.empty(shape, dtype=dtype) for _ in range(num_buffers)]
+
+        # batch i is rendered into buffer i % num_buffers, which is free
+        # again once the caller has moved on to batch i + 1
+        with ThreadPoolExecutor(num_workers) as pool:
+            pending = deque(pool.submit(render, i, buffers[i % num_buffers])
+                            for i in range(min(num_buffers - 1, len(starts))))
+            for i in range(len(starts)):
+                images = pending.popleft().result()
+                j = i + num_buffers - 1
+                if j < len(starts):
+                    pending.append(pool.submit(render, j, buffers[j % num_buffers]))
+                yield images
 
     def images(self):
         num_stims = np.prod(self.num_params)
-        return np.array([self.gabor_from_idx(i) for i in range(num_stims)])
+        return self.gabors(np.arange(num_stims))
+
+
+def _unique_rows(*columns):
+    '''Index of the first occurrence of each unique row and inverse mapping'''
+    _, first, inverse = np.unique(np.stack(columns, axis=1), axis=0,
+                                  return_index=True, return_inverse=True)
+    return first, inverse.reshape(-1)
+
+
+def coarse_to_fine_search(gabor_set, evaluate, num_candidates=8, coarse_size=3,
+                          max_stimuli=None, batch_size=1024, num_seeds=128,
+                          periodic=(False, False, False, False, False, True, True)):
+    """Adaptive search for the optimal Gabor of each unit.
+
+    The parameter axes [x, y, size, SF, contrast, orientation, phase] of the
+    Gabor set are first sampled with a step of about 1/coarse_size of their
+    length (the last value of non-periodic axes is always included). The
+    num_candidates best stimuli of each unit are then refined by evaluating
+    their neighbours at +/- step along each axis (jointly for x and y,
+    including diagonals). The step is halved when no new stimulus enters the
+    candidates, until neighbours at step 1 do not improve anymore.
+    Orientation and phase wrap around (periodic).
+
+    The refinement then restarts from the next num_candidates best grid
+    stimuli of each unit (up to num_seeds), to find maxima that the first
+    candidates did not lead to. Once all seeds are used, the search
+    continues on a grid with half the step (skipping evaluated stimuli).
+    This goes on until max_stimuli stimuli have been evaluated. The last
+    grid has step 1, so without a budget the result is the same as for the
+    exhaustive search. With a budget, units can miss their maximum; the
+    number of units that still improved in the last restart is printed as
+    an indication.
+
+    evaluate(images) returns the responses [num_images, num_units].
+
+    Returns the maximum response and its index (as in the exhaustive search)
+    for each unit and the number of evaluated stimuli.
+    """
+    cr = gabor_set.center_range
+    shape = np.array([cr[1] - cr[0], cr[3] - cr[2]] + gabor_set.num_params[1:])
+    periodic = np.array(periodic)
+    new, grid_steps = coarse_grid(gabor_set, coarse_size, periodic)
+    steps = grid_steps
+    num_stimuli = np.prod(shape)
+    max_stimuli = min(max_stimuli or num_stimuli, num_stimuli)
+    rnd = np.random.RandomState(0)
+
+    evaluated = np.zeros(0, dtype=int)
+    top_r, top_idx = None, None      # best stimuli so far
+    local_r, local_idx = None, None  # candidates of the current refinement
+    seed_r, seed_idx = None, None    # best stimuli of the current grid
+    grid, seed_rank, restart_r = True, num_candidates, None
+    while len(new) and len(evaluated) < max_stimuli:
+        new = new[:max_stimuli - len(evaluated)]
+        for batch_start in range(0, len(new), batch_size):
+            idx = new[batch_start:batch_start+batch_size]
+            r = evaluate(gabor_set.gabors(idx))
+            top_r, top_idx = top_candidates(top_r, top_idx, r, idx, num_candidates)
+            local_r, local_idx = top_candidates(local_r, local_idx, r, idx, num_candidates)
+            if grid:
+                seed_r, seed_idx = top_candidates(seed_r, seed_idx, r, idx, num_seeds)
+        evaluated = np.union1d(evaluated, new)
+        if not np.isin(local_idx, new).any():
+            steps = np.maximum(steps // 2, 1)
+        grid = False
+
+        while True:
+            new, steps = _refine(local_r, local_idx, steps, shape, periodic, evaluated)
+            if len(new):
+                break
+
+            # converged: restart from the next best seeds or a finer grid
+            restart_r = top_r.max(axis=0)
+            if seed_rank < len(seed_r):
+                order = np.argsort(-seed_r, axis=0)[seed_rank:seed_rank+num_candidates]
+                local_r = np.take_along_axis(seed_r, order, axis=0)
+                local_idx = np.take_along_axis(seed_idx, order, axis=0)
+                seed_rank += num_candidates
+                steps = grid_steps
+            else:
+                if np.any(grid_steps > 1):
+                    grid_steps = np.maximum(grid_steps // 2, 1)
+                    new = _grid(shape, grid_steps, periodic)
+                    new = rnd.permutation(new[~np.isin(new, evaluated)])
+                    steps = grid_steps
+                    local_r, local_idx, seed_r, seed_idx = None, None, None, None
+                    grid, seed_rank = True, num_candidates
+                break
+
+    units = np.arange(top_r.shape[1])
+    best = top_r.argmax(axis=0)
+    if len(evaluated) < num_stimuli:
+        # before the first restart, all units count as still improving
+        improved = top_r.max(axis=0) > (-np.inf if restart_r is None else restart_r)
+        print('Evaluated {:d} of {:d} stimuli, {:d} of {:d} units still improved after the '
+              'last restart'.format(len(evaluated), num_stimuli, improved.sum(), len(units)))
+    return top_r[best, units], top_idx[best, units], len(evaluated)
+
+
+def _refine(top_r, top_idx, steps, shape, periodic, evaluated):
+    # unevaluated neighbours of the candidates (best first), halving the
+    # steps until there are any
+    order = np.argsort(-top_r, axis=0)
+    candidates = _unique_ordered(np.take_along_axis(top_idx, order, axis=0).ravel())
+    while True:
+        new = _neighbours(candidates, shape, steps, periodic)
+        new = new[~np.isin(new, evaluated)]
+        if len(new) or np.all(steps == 1):
+            return new, steps
+        steps = np.maximum(steps // 2, 1)
+
+
+def coarse_grid(gabor_set, coarse_size=3,
+                periodic=(False, False, False, False, False, True, True)):
+    """Indices of a coarse subgrid of a Gabor set and its step along each axis.
+
+    See coarse_to_fine_search for the axes and the choice of steps.
+    """
+    cr = gabor_set.center_range
+    shape = np.array([cr[1] - cr[0], cr[3] - cr[2]] + gabor_set.num_params[1:])
+    steps = 2 ** np.floor(np.log2(np.maximum(shape / coarse_size, 1))).astype(int)
+    return _grid(shape, steps, periodic), steps
+
+
+def _grid(shape, steps, periodic):
+    axes = [np.arange(0, n, st) if p else np.union1d(np.arange(0, n, st), [n-1])
+            for n, st, p in zip(shape, steps, periodic)]
+    return np.ravel_multi_index(np.meshgrid(*axes, indexing='ij'), shape).ravel()
+
+
+def top_candidates(top_r, top_idx, r, idx, num_candidates):
+    """Update the num_candidates largest responses of each unit.
+
+    r are responses [num_stimuli, num_units] to the stimuli idx. top_r and
+    top_idx are the current candidates [num_candidates, num_units] (None
+    to start).
+    """
+    idx = np.broadcast_to(np.asarray(idx)[:,None], r.shape)
+    if top_r is not None:
+        r = np.concatenate([top_r, r], axis=0)
+        idx = np.concatenate([top_idx, idx], axis=0)
+    k = min(num_candidates, len(r))
+    top = np.argpartition(-r, k - 1, axis=0)[:k]
+    return np.take_along_axis(r, top, axis=0), np.take_along_axis(idx, top, axis=0)
+
+
+def _neighbours(idx, shape, steps, periodic):
+    # location (x, y) moves jointly (including diagonals), other axes separately
+    coords = np.array(np.unravel_index(idx, shape))
+    moves = [d for d in product([-1, 0, 1], repeat=2) if any(d)]
+    moves = [list(d) + [0] * (len(shape) - 2) for d in moves]
+    moves += [d for axis in range(2, len(shape)) for d in
+              [np.eye(len(shape), dtype=int)[axis], -np.eye(len(shape), dtype=int)[axis]]]
+    neighbours = []
+    for move in np.array(moves) * steps:
+        c = coords + move[:,None]
+        c = np.where(periodic[:,None], c % shape[:,None], np.clip(c, 0, shape[:,None] - 1))
+        neighbours.append(np.ravel_multi_index(c, shape))
+    return _unique_ordered(np.stack(neighbours, axis=1).ravel())
+
+
+def _unique_ordered(x):
+    _, first = np.unique(x, return_index=True)
+    return x[np.sort(first)]